@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Syntax: check-viterbi-excluding.py [lattice ...] [--random N] [--seed SEED]
+#
+# Checks that WordLattice.viterbi_excluding() finds the same best paths as
+# removing each word from a copy of the lattice and calling viterbi(). Every
+# word of each lattice is excluded in turn, as well as a word that does not
+# appear in the lattice. The lattices can be read from SLF files, or generated
+# randomly with --random.
+#
+# The scores have to agree within rounding error, and the excluded word must
+# not appear in the hypothesis. The hypotheses themselves may differ when
+# several paths have the same score. Prints the number of checked cases, and
+# exits with status 1 if any of them failed.
+
+import argparse
+import io
+import random
+import sys
+from wordlattice import WordLattice
+from filetypes import TextFileType
+
+# Generates a random lattice in SLF format. The nodes are numbered in an
+# arbitrary order, and there is always a path from the start node to the end
+# node.
+def random_slf(rng):
+	num_nodes = rng.randint(2, 25)
+	num_links = rng.randint(num_nodes, 70)
+	vocabulary = ['w%d' % i for i in range(rng.randint(3, 10))] + ['!NULL']
+	node_ids = rng.sample(range(100), num_nodes)
+	links = [(i, i + 1) for i in range(num_nodes - 1)]
+	for i in range(num_links - len(links)):
+		start = rng.randrange(num_nodes - 1)
+		links.append((start, rng.randrange(start + 1, num_nodes)))
+	rng.shuffle(links)
+
+	lines = ["VERSION=1.1", "lmscale=12.0",
+	         "start=%d" % node_ids[0], "end=%d" % node_ids[-1],
+	         "NODES=%d LINKS=%d" % (num_nodes, len(links))]
+	for i, node_id in enumerate(node_ids):
+		lines.append("I=%d\tt=%d" % (node_id, i))
+	for i, (start, end) in enumerate(links):
+		lines.append("J=%d\tS=%d\tE=%d\tW=%s\ta=%.3f\tl=%.3f" % \
+			(i, node_ids[start], node_ids[end], rng.choice(vocabulary),
+			 rng.uniform(-500, 0), rng.uniform(-10, 0)))
+	return "\n".join(lines) + "\n"
+
+# Compares viterbi_excluding() to without_words() and viterbi() on every word
+# of the lattice. Returns the number of checked cases and the number of
+# failures.
+def check_lattice(lattice, name, lm_scale, wip):
+	words = sorted(lattice.words()) + ['<no such word>']
+	results = lattice.viterbi_excluding(words, lm_scale, wip)
+	num_failures = 0
+	for word, (words_found, score_found) in zip(words, results):
+		words_expected, score_expected = \
+			lattice.without_words([word]).viterbi(lm_scale, wip)
+		if words_expected is None:
+			ok = (words_found is None) and (score_found == float('-inf'))
+		else:
+			tolerance = 1e-9 * max(1, abs(score_expected))
+			ok = (words_found is not None) and \
+			     (abs(score_found - score_expected) <= tolerance) and \
+			     (word not in words_found)
+		if not ok:
+			num_failures += 1
+			sys.stderr.write("%s: excluding %s: expected %s %s, found %s %s\n" % \
+				(name, word, score_expected, words_expected, score_found,
+				 words_found))
+	return len(words), num_failures
+
+parser = argparse.ArgumentParser()
+parser.add_argument('lattice', type=TextFileType('r'), nargs='*', help='lattice files to check')
+parser.add_argument('--random', metavar='N', type=int, default=0,
+                   help='check also N randomly generated lattices')
+parser.add_argument('--seed', type=int, default=1,
+                   help='random seed for generating the lattices')
+args = parser.parse_args()
+
+num_cases = 0
+num_failures = 0
+for lattice_file in args.lattice:
+	lattice = WordLattice()
+	lattice.read_slf(lattice_file)
+	lattice_file.close()
+	for lm_scale, wip in [(None, 0), (1, -5)]:
+		cases, failures = check_lattice(lattice, lattice_file.name, lm_scale, wip)
+		num_cases += cases
+		num_failures += failures
+
+rng = random.Random(args.seed)
+for index in range(args.random):
+	lattice = WordLattice()
+	lattice.read_slf(io.StringIO(random_slf(rng)))
+	# Exclusion should work also after some words have been removed.
+	if index % 4 == 0:
+		words = sorted(lattice.words())
+		lattice.remove_words(set(rng.sample(words, min(2, len(words)))))
+	lm_scale = rng.choice([None, 1])
+	wip = rng.choice([0, -5])
+	cases, failures = check_lattice(lattice, "random lattice %d" % index, lm_scale, wip)
+	num_cases += cases
+	num_failures += failures
+
+sys.stdout.write("%d cases checked, %d failed.\n" % (num_cases, num_failures))
+if num_failures > 0:
+	sys.exit(1)
@@ -3,11 +3,10 @@
 #
 # Syntax: decode-reduced-lattice.py [lattice] [--exclude word1 word2 ...] [--exclude-individually word1 word2 ...]
 #
-# Evaluates a word lattice using lattice-tool after removing a number of words
-# from it.
+# Evaluates a word lattice after removing a number of words from it.
 #
 # First removes all the words given with --exclude command line argument from the
-# lattice. Decodes the lattice using lattice-tool, and writes the result on the
+# lattice. Decodes the lattice using the Viterbi algorithm, and writes the result on the
 # first output line, e.g. "<s> the sun has now set </s>". Then, one by one removes
 # the words given with --exclude-individually command line argument. Each word
 # excluded, decodes the lattice and writes the result on a separate line, preceded
@@ -15,44 +14,28 @@
 #
 # If the end node is not reachable, the sentence will be empty, but the line
 # will still be printed.
+#
+# The score of a link is a + lmscale * l + wip, where lmscale is taken from the
+# lattice header unless --lm-scale is given, and the word insertion penalty wip
+# is not added to !NULL links.
 
 import argparse
 import sys
-import codecs
-import os
-import tempfile
-import subprocess
 from wordlattice import WordLattice
 from filetypes import TextFileType
 
-def decode_lattice(lattice):
-	if lattice.end_node == -1:
+# Formats the words returned by the decoder as a hypothesis, e.g. "<s> the sun
+# has now set </s>", or an empty string if the end node was not reachable. Adds
+# sentence boundaries if the lattice does not contain them, as lattice-tool
+# does.
+def format_hypothesis(words):
+	if words is None:
 		return ""
-
-	slf_file = tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8')
-	lattice.write_slf(slf_file)
-	slf_file.flush()
-
-	command = ['lattice-tool', '-in-lattice', slf_file.name, '-read-htk', '-viterbi-decode']
-	proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	output, errors = proc.communicate()
-	output = output.decode('utf-8')
-	output = output.rstrip()
-	errors = errors.decode('utf-8')
-	if proc.returncode:
-		raise Exception(' '.join(command) + " failed with code %s" % proc.returncode)
-	for line in errors.splitlines():
-		if "warning" in line:
-			continue
-		# The end node was unreachable.
-		return ""
-
-	try:
-		hypothesis_pos = output.index(' ') + 1
-		return output[hypothesis_pos:]
-	except ValueError:
-		sys.stderr.write('Warning: no space in lattice-tool output ref "%s".\n' % output)
-		return ''
+	if (len(words) == 0) or (words[0] != '<s>'):
+		words.insert(0, '<s>')
+	if words[-1] != '</s>':
+		words.append('</s>')
+	return ' '.join(words)
 
 parser = argparse.ArgumentParser()
 parser.add_argument('lattice', type=TextFileType('r'), help='a lattice file')
@@ -60,6 +43,10 @@ parser.add_argument('--exclude', dest='exclude_always', metavar='word', type=str
                    help='words to exclude from every decoding')
 parser.add_argument('--exclude-individually', dest='exclude_once', metavar='word', type=str, nargs='*', default=[],
                    help='words to exclude individually, each word once, or ! for all the words in the original hypothesis')
+parser.add_argument('--lm-scale', metavar='SCALE', type=float, default=None,
+                   help='LM scale factor (default is lmscale from the lattice header)')
+parser.add_argument('--wip', metavar='PENALTY', type=float, default=0,
+                   help='word insertion penalty (default is 0)')
 args = parser.parse_args()
 
 lattice = WordLattice()
@@ -70,7 +57,8 @@ sentence_boundaries = set(['<s>', '</s>'])
 
 exclude_always = set(args.exclude_always) - sentence_boundaries
 lattice.remove_words(exclude_always)
-hypothesis = decode_lattice(lattice)
+words, score = lattice.viterbi(args.lm_scale, args.wip)
+hypothesis = format_hypothesis(words)
 sys.stdout.write(hypothesis + "\n")
 
 if "!" in args.exclude_once:
@@ -79,8 +67,11 @@ else:
 	exclude_once = set(args.exclude_once)
 exclude_once -= exclude_always
 exclude_once -= sentence_boundaries
+exclude_once = list(exclude_once)
 
-for word in exclude_once:
-	reduced_lattice = lattice.without_words([word])
-	hypothesis = decode_lattice(reduced_lattice)
+# The best paths without each word are found from the same forward and
+# backward scores, without copying the lattice.
+results = lattice.viterbi_excluding(exclude_once, args.lm_scale, args.wip)
+for word, (words, score) in zip(exclude_once, results):
+	hypothesis = format_hypothesis(words)
 	sys.stdout.write(word + " " + hypothesis + "\n")
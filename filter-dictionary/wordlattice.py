@@ -2,25 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import re
-import sys
-from bisect import bisect_left, bisect_right
-from copy import deepcopy
+import itertools
+import numpy
 
 class WordLattice:
-	class Node:
-		def __init__(self, id_arg, time):
-			self.id = id_arg
-			self.time = time
-			self.reference_count = 0
-		
-		def refer(self):
-			self.reference_count = self.reference_count + 1
-		
-		def unrefer(self):
-			self.reference_count = self.reference_count - 1
-			return self.reference_count == 0
-	
+	# A link of the lattice. Links are stored in arrays, and Link objects are
+	# only created when links are requested through links_from().
 	class Link:
+		__slots__ = ['id', 'start_node', 'end_node', 'word', 'ac_score', 'lm_score']
+
 		def __init__(self, id_arg, start_node, end_node, word, ac_score,
 					lm_score):
 			self.id = id_arg
@@ -29,25 +19,25 @@ class WordLattice:
 			self.word = word
 			self.ac_score = ac_score
 			self.lm_score = lm_score
-			
+
 		def __repr__(self):
 			return "\t".join([str(self.start_node), str(self.end_node), \
-							self.word.encode(sys.stdout.encoding), str(self.ac_score), str(self.lm_score)])
-	
+							self.word, str(self.ac_score), str(self.lm_score)])
+
 	class Path:
 		# Constructs a path given a list of node IDs.
 		def __init__(self, links = []):
 			self.__links = links
-		
+
 		def __repr__(self):
 			result = "\n".join(str(x) for x in self.__links) + "\n"
 			result += "\t\t\t" + str(self.total_ac_score())
 			result += "\t" + str(self.total_lm_score())
 			return result
-			
+
 		def empty(self):
 			return len(self.__links) == 0
-		
+
 		# Returns the node ID of the final node in this path, or -1 if this is
 		# an empty path.
 		def final_node(self):
@@ -55,100 +45,274 @@ class WordLattice:
 				return -1
 			else:
 				return self.__links[-1].end_node
-		
+
 		def append(self, link):
 			self.__links.append(link)
-		
+
 		# Returns a list of expansions of the path, one for each of the given
 		# links.
 		def create_expansions(self, links):
 			return [WordLattice.Path(self.__links + [x]) for x in links]
-		
+
 		def total_ac_score(self):
 			return sum(x.ac_score for x in self.__links)
-		
+
 		def total_lm_score(self):
 			return sum(x.lm_score for x in self.__links)
 
-	# A list of links and nodes.	
-	class LNList:
-		def __init__(self):
-			self.links = []
-			self.nodes = []
-		
-		def extend(self, other):
-			self.links.extend(other.links)
-			self.nodes.extend(other.nodes)
-	
+	# A view of a lattice with some links removed. The view shares the arrays
+	# of the lattice and only stores a mask of the links that are kept, so
+	# removing words from a view does not copy anything. Nodes are not removed
+	# from a view, but a node whose incoming links are all removed is no
+	# longer reachable, so the best paths are the same as after remove_words().
+	class View:
+		def __init__(self, lattice, link_mask):
+			self.lattice = lattice
+			self.link_mask = link_mask
+
+		# Returns a view with the links that contain any of the given words
+		# removed.
+		def without_words(self, words):
+			link_mask = self.link_mask & ~self.lattice.word_mask(words)
+			return WordLattice.View(self.lattice, link_mask)
+
+		def num_links(self):
+			return int(numpy.count_nonzero(self.link_mask))
+
+		# Returns the set of nodes that are reachable through the links of
+		# the view.
+		def reachable_nodes(self):
+			return self.lattice.reachable_nodes(link_mask=self.link_mask)
+
+		def viterbi(self, lm_scale=None, wip=0):
+			return self.lattice.viterbi(lm_scale, wip, self.link_mask)
+
+		def viterbi_excluding(self, words, lm_scale=None, wip=0):
+			return self.lattice.viterbi_excluding(words, lm_scale, wip,
+			                                      self.link_mask)
+
+		# Returns a new lattice that contains the links of the view. Nodes are
+		# removed as in remove_words().
+		def copy(self):
+			result = WordLattice()
+			result.vocabulary = list(self.lattice.vocabulary)
+			result.word_ids = dict(self.lattice.word_ids)
+			result.lm_scale = self.lattice.lm_scale
+			self.lattice.copy_links(result, self.link_mask)
+			return result
+
+	# Preallocated arrays that are filled one row at a time while reading a
+	# lattice. The capacity is doubled when the arrays are full.
+	class Columns:
+		def __init__(self, dtypes, capacity):
+			self.size = 0
+			self.columns = [numpy.empty(max(capacity, 1), dtype=x)
+			                for x in dtypes]
+
+		# Makes sure that there is space for at least one more row.
+		def reserve(self):
+			if self.size == len(self.columns[0]):
+				self.columns = [numpy.resize(x, 2 * len(x))
+				                for x in self.columns]
+
+		def append(self, *values):
+			self.reserve()
+			for column, value in zip(self.columns, values):
+				column[self.size] = value
+			self.size += 1
+
+		# Returns the filled part of each array.
+		def arrays(self):
+			return [x[:self.size] for x in self.columns]
+
+	# The lattice is stored in columnar form. Nodes are identified by their
+	# index, and node_times contains the time of each node. The links are
+	# stored in arrays that are sorted by start node: link_ids, link_starts,
+	# link_ends, link_words, ac_scores, and lm_scores. Words are stored as IDs
+	# to the vocabulary list. link_offsets[i] is the index of the first link
+	# that starts from node i, so the links from node i are
+	# link_offsets[i]:link_offsets[i+1] (compressed sparse row format). The
+	# links to node i are in_links[in_offsets[i]:in_offsets[i+1]].
 	def __init__(self):
 		# A regular expression for fields such as E=997788 or W="that is" in an
 		# SLF file.
 		self.assignment_re = re.compile(r'(\S+)=(?:"((?:[^\\"]+|\\.)*)"|(\S+))')
-		
+		self.vocabulary = []
+		self.word_ids = dict()
+
 	def __deepcopy__(self, memo={}):
 		result = WordLattice()
 		memo[id(self)] = result
-		result.__nodes = deepcopy(self.__nodes, memo)
-		result.__links = deepcopy(self.__links, memo)
-		result.__start_nodes_of_links = deepcopy(self.__start_nodes_of_links, memo)
+		result.vocabulary = list(self.vocabulary)
+		result.word_ids = dict(self.word_ids)
+		result.node_times = self.node_times.copy()
+		result.link_ids = self.link_ids.copy()
+		result.link_starts = self.link_starts.copy()
+		result.link_ends = self.link_ends.copy()
+		result.link_words = self.link_words.copy()
+		result.ac_scores = self.ac_scores.copy()
+		result.lm_scores = self.lm_scores.copy()
+		result.link_offsets = self.link_offsets.copy()
+		result.in_links = self.in_links.copy()
+		result.in_offsets = self.in_offsets.copy()
+		result.__waves = None
 		result.start_node = self.start_node
 		result.end_node = self.end_node
 		result.lm_scale = self.lm_scale
 		return result
-		
+
+	# Returns the ID of a word in the vocabulary of this lattice, adding the
+	# word if necessary.
+	def word_id(self, word):
+		result = self.word_ids.get(word)
+		if result is None:
+			result = len(self.vocabulary)
+			self.vocabulary.append(word)
+			self.word_ids[word] = result
+		return result
+
+	# Reads a lattice in HTK Standard Lattice Format. Node and link lines are
+	# parsed by splitting them at whitespace, when they are in the usual
+	# I= t= and J= S= E= W= a= l= layout. Other lines, and lines that contain
+	# quoted or escaped fields, are parsed with a regular expression. The
+	# arrays are preallocated using the NODES= and LINKS= header fields.
 	def read_slf(self, input_file):
-		self.__nodes = []
-		self.__links = []
 		self.lm_scale = 1
-		
-		at_header = True
+		start_node = None
+		end_node = None
+		num_nodes = 1024
+		num_links = 1024
+
+		line = None
 		for line in input_file:
 			if line.startswith('#'):
 				continue
-			fields = dict([(x[0], x[1] or x[2]) for x in self.assignment_re.findall(line.rstrip())])
-			if at_header:
-				if 'start' in fields:
-					self.start_node = int(fields['start'])
-				if 'end' in fields:
-					self.end_node = int(fields['end'])
-				if 'lmscale' in fields:
-					self.lm_scale = float(fields['lmscale'])
-				if ('I' in fields) or ('J' in fields):
-					at_header = False
-			if not at_header:
-				if 'I' in fields:
-					node_id = int(fields['I'])
-					if 't' in fields:
-						node_time = int(fields['t'])
-					else:
-						node_time = 0
-					self.__nodes.append(self.Node(node_id, node_time))
-				elif 'J' in fields:
-					link_id = int(fields['J'])
-					start_node = int(fields['S'])
-					end_node = int(fields['E'])
-					word = fields['W']
-					if 'a' in fields:
-						ac_score = float(fields['a'])
-					else:
-						ac_score = 0
-					lm_score = float(fields['l'])
-					self.__links.append(self.Link(link_id, start_node, end_node,
-											word, ac_score, lm_score))
-
-		if len(self.__nodes) == 0:
+			fields = self.__parse_fields(line)
+			if ('I' in fields) or ('J' in fields):
+				break
+			if 'start' in fields:
+				start_node = int(fields['start'])
+			if 'end' in fields:
+				end_node = int(fields['end'])
+			if 'lmscale' in fields:
+				self.lm_scale = float(fields['lmscale'])
+			num_nodes = int(fields.get('NODES', fields.get('N', num_nodes)))
+			num_links = int(fields.get('LINKS', fields.get('L', num_links)))
+		else:
+			line = None
+
+		nodes = self.Columns(['int64', 'int64'], num_nodes)
+		links = self.Columns(['int64', 'int64', 'int64', 'int32',
+		                      'float64', 'float64'], num_links)
+		if line is not None:
+			self.__parse_lines(itertools.chain([line], input_file),
+			                   nodes, links)
+
+		if nodes.size == 0:
 			raise Exception("No nodes read.")
-		if not hasattr(self, 'start_node'):
-			self.start_node = self.__nodes[0]
-		if not hasattr(self, 'end_node'):
-			self.end_node = self.__nodes[-1]
-		
-		self.__nodes_updated()
+		node_ids, node_times = nodes.arrays()
+		if start_node is None:
+			start_node = int(node_ids[0])
+		if end_node is None:
+			end_node = int(node_ids[-1])
+
+		self.__set_arrays(node_ids, node_times, start_node, end_node,
+		                  *links.arrays())
+
+	# Parses the node and link lines of an SLF file into the columns. This is
+	# the inner loop of read_slf(), so lines in the usual layout are handled
+	# without function calls.
+	def __parse_lines(self, lines, nodes, links):
+		word_ids = self.word_ids
+		ids, starts, ends, words, ac_scores, lm_scores = links.columns
+		for line in lines:
+			if ('"' in line) or ('\\' in line):
+				if not line.startswith('#'):
+					self.__parse_fields_line(line, nodes, links)
+					ids, starts, ends, words, ac_scores, lm_scores = links.columns
+				continue
+
+			tokens = line.split()
+			if not tokens:
+				continue
+			key = tokens[0][:2]
+			if (key == 'J=') and (len(tokens) >= 4) \
+			   and (tokens[1][:2] == 'S=') and (tokens[2][:2] == 'E=') \
+			   and (tokens[3][:2] == 'W='):
+				ac_score = 0
+				lm_score = None
+				for token in tokens[4:]:
+					key = token[:2]
+					if key == 'a=':
+						ac_score = float(token[2:])
+					elif key == 'l=':
+						lm_score = float(token[2:])
+				if lm_score is None:
+					self.__parse_fields_line(line, nodes, links)
+					continue
+				word = tokens[3][2:]
+				word_id = word_ids.get(word)
+				if word_id is None:
+					word_id = self.word_id(word)
+				index = links.size
+				if index == len(ids):
+					links.reserve()
+					ids, starts, ends, words, ac_scores, lm_scores = links.columns
+				ids[index] = int(tokens[0][2:])
+				starts[index] = int(tokens[1][2:])
+				ends[index] = int(tokens[2][2:])
+				words[index] = word_id
+				ac_scores[index] = ac_score
+				lm_scores[index] = lm_score
+				links.size = index + 1
+			elif key == 'I=':
+				time = 0
+				for token in tokens[1:]:
+					if token[:2] == 't=':
+						time = int(token[2:])
+				nodes.append(int(tokens[0][2:]), time)
+			elif key[:1] != '#':
+				self.__parse_fields_line(line, nodes, links)
+				ids, starts, ends, words, ac_scores, lm_scores = links.columns
+
+	# Parses a node or link line of an SLF file using the regular expression.
+	def __parse_fields_line(self, line, nodes, links):
+		fields = self.__parse_fields(line)
+		if 'I' in fields:
+			nodes.append(int(fields['I']), int(fields.get('t', 0)))
+		elif 'J' in fields:
+			links.append(int(fields['J']), int(fields['S']), int(fields['E']),
+			             self.word_id(fields['W']), float(fields.get('a', 0)),
+			             float(fields['l']))
+
+	# Returns a dictionary of the fields on an SLF line.
+	def __parse_fields(self, line):
+		return dict([(x[0], x[1] or x[2]) for x in self.assignment_re.findall(line.rstrip())])
+
+	# Stores the nodes and links in arrays. Gives nodes linear IDs so that
+	# they can be indexed by node ID, and sorts the links by start node.
+	def __set_arrays(self, node_ids, node_times, start_node, end_node,
+	                 link_ids, link_starts, link_ends, link_words,
+	                 ac_scores, lm_scores):
+		node_ids = numpy.asarray(node_ids, dtype='int64')
+		mapping = numpy.full(node_ids.max() + 1, -1, dtype='int32')
+		mapping[node_ids] = numpy.arange(len(node_ids), dtype='int32')
+		self.node_times = numpy.asarray(node_times, dtype='int64')
+		self.start_node = int(mapping[start_node])
+		if end_node != -1:
+			self.end_node = int(mapping[end_node])
+		else:
+			self.end_node = -1
+
+		link_starts = mapping[numpy.asarray(link_starts, dtype='int64')]
+		order = numpy.argsort(link_starts, kind='stable')
+		self.link_ids = numpy.asarray(link_ids, dtype='int64')[order]
+		self.link_starts = link_starts[order]
+		self.link_ends = mapping[numpy.asarray(link_ends, dtype='int64')][order]
+		self.link_words = numpy.asarray(link_words, dtype='int32')[order]
+		self.ac_scores = numpy.asarray(ac_scores, dtype='float64')[order]
+		self.lm_scores = numpy.asarray(lm_scores, dtype='float64')[order]
 		self.__links_updated()
-		
-		self.__nodes[self.start_node].refer()
-		for link in self.__links:
-			self.__nodes[link.end_node].refer()
 
 	def write_slf(self, output_file):
 		output_file.write("# Header\n")
@@ -158,24 +322,33 @@ class WordLattice:
 		output_file.write("lmscale=" + str(self.lm_scale) + "\n")
 		output_file.write("start=" + str(self.start_node) + "\n")
 		output_file.write("end=" + str(self.end_node) + "\n")
-		output_file.write("NODES=" + str(len(self.__nodes)))
-		output_file.write(" LINKS=" + str(len(self.__links)) + "\n")
-		
+		output_file.write("NODES=" + str(self.num_nodes()))
+		output_file.write(" LINKS=" + str(self.num_links()) + "\n")
+
 		output_file.write("# Nodes\n")
-		for node in self.__nodes:
-			output_file.write("I=" + str(node.id))
-			output_file.write("\tt=" + str(node.time) + "\n")
-		
+		for node_id, time in enumerate(self.node_times.tolist()):
+			output_file.write("I=" + str(node_id))
+			output_file.write("\tt=" + str(time) + "\n")
+
 		output_file.write("# Links\n")
-		for link in self.__links:
-			output_file.write("J=" + str(link.id))
-			output_file.write("\tS=" + str(link.start_node))
-			output_file.write("\tE=" + str(link.end_node))
-			output_file.write("\tW=" + link.word)
-			output_file.write("\ta=" + str(link.ac_score))
+		columns = zip(self.link_ids.tolist(), self.link_starts.tolist(),
+		              self.link_ends.tolist(), self.link_words.tolist(),
+		              self.ac_scores.tolist(), self.lm_scores.tolist())
+		for link_id, start, end, word, ac_score, lm_score in columns:
+			output_file.write("J=" + str(link_id))
+			output_file.write("\tS=" + str(start))
+			output_file.write("\tE=" + str(end))
+			output_file.write("\tW=" + self.vocabulary[word])
+			output_file.write("\ta=" + str(ac_score))
 			output_file.write("\tv=0")
-			output_file.write("\tl=" + str(link.lm_score) + "\n")
-	
+			output_file.write("\tl=" + str(lm_score) + "\n")
+
+	def num_nodes(self):
+		return len(self.node_times)
+
+	def num_links(self):
+		return len(self.link_ids)
+
 	# Finds a path from start node to end node through given words.
 	def find_paths(self, words):
 		tokens = self.expand_path_to_null_links(self.Path())
@@ -196,13 +369,22 @@ class WordLattice:
 			if path.final_node() == self.end_node:
 				result.append(path)
 		return result
-	
+
 	# Returns the range of links with given start node.
 	def links_from(self, node_id):
-		first = bisect_left(self.__start_nodes_of_links, node_id)
-		last = bisect_right(self.__start_nodes_of_links, node_id)
-		return self.__links[first:last]
-	
+		first = self.link_offsets[node_id]
+		last = self.link_offsets[node_id + 1]
+		return [self.__link(x) for x in range(first, last)]
+
+	# Creates a Link object from the link with given index.
+	def __link(self, index):
+		return self.Link(int(self.link_ids[index]),
+		                 int(self.link_starts[index]),
+		                 int(self.link_ends[index]),
+		                 self.vocabulary[self.link_words[index]],
+		                 float(self.ac_scores[index]),
+		                 float(self.lm_scores[index]))
+
 	# Returns a list of paths that have been formed my advancing from given path
 	# to all the !NULL links and recursively to the next !NULL links. the given
 	# path is also included. If the given path is empty, starts from the global
@@ -212,18 +394,18 @@ class WordLattice:
 			start_node = self.start_node
 		else:
 			start_node = path.final_node()
-		
+
 		expansion_links = []
 		for link in self.links_from(start_node):
 			if link.word == "!NULL":
 				expansion_links.append(link)
 		expanded_paths = path.create_expansions(expansion_links)
-		
+
 		result = [path]
 		for expanded_path in expanded_paths:
 			result.extend(self.expand_path_to_null_links(expanded_path))
 		return result
-	
+
 	# Returns a list of paths that have been formed by advancing from given path
 	# to all the links with given word.
 	def find_extensions(self, path, word):
@@ -232,94 +414,328 @@ class WordLattice:
 			if link.word == word:
 				links.append(link)
 		return path.create_expansions(links)
-	
+
 	# Returns the set of words present in this lattice.
 	def words(self):
-		result = set()
-		for link in self.__links:
-			if link.word != '!NULL':
-				result.add(link.word)
+		result = set(self.vocabulary[x] for x in numpy.unique(self.link_words))
+		result.discard('!NULL')
 		return result
-	
+
 	# Returns the set of node IDs present in this lattice.
 	def node_ids(self):
-		return set(x.id for x in self.__nodes)
-	
-	# Returns the set of reachable nodes in the lattice.
-	def reachable_nodes(self, start_node=None):
+		return set(range(self.num_nodes()))
+
+	# Returns the set of reachable nodes in the lattice. If link_mask is given,
+	# only the links where it is True are followed.
+	def reachable_nodes(self, start_node=None, link_mask=None):
 		if start_node is None:
 			start_node = self.start_node
-		
-		result = set([start_node])
-		for link in self.links_from(start_node):
-			result.update(self.reachable_nodes(link.end_node))
-		return result
-	
+
+		reachable = numpy.zeros(self.num_nodes(), dtype=bool)
+		reachable[start_node] = True
+		stack = [start_node]
+		while stack:
+			node_id = stack.pop()
+			first = self.link_offsets[node_id]
+			last = self.link_offsets[node_id + 1]
+			ends = self.link_ends[first:last]
+			if link_mask is not None:
+				ends = ends[link_mask[first:last]]
+			ends = ends[~reachable[ends]]
+			reachable[ends] = True
+			stack.extend(numpy.unique(ends).tolist())
+		return set(numpy.flatnonzero(reachable).tolist())
+
 	# Returns the set of unreachable nodes in the lattice.
 	def unreachable_nodes(self):
 		return self.node_ids() - self.reachable_nodes()
-	
-	# Remove links that contain a word from the given list.
+
+	# Returns a boolean array that tells which links contain a word from the
+	# given list.
+	def word_mask(self, words):
+		word_ids = [self.word_ids[x] for x in words if x in self.word_ids]
+		return numpy.isin(self.link_words, word_ids)
+
+	# Returns a view of the lattice that shares the arrays of this lattice.
+	# Words can be removed from the view without copying the lattice.
+	def view(self):
+		return self.View(self, numpy.ones(self.num_links(), dtype=bool))
+
+	# Remove links that contain a word from the given list. Nodes that are
+	# left without incoming links are removed too, and so on recursively.
 	def remove_words(self, words):
-		to_delete = self.LNList()
-		for link in self.__links:
-			if link.word in words:
-				to_delete.links.append(link.id)
-				to_delete.extend(self.__unlink(link.end_node))
-		
-		for link in self.__links:
-			if (link.start_node in to_delete.nodes) or \
-			   (link.end_node in to_delete.nodes):
-				to_delete.links.append(link.id)
-		
-		if self.end_node in to_delete.nodes:
-			self.end_node = -1
-		
-		self.__links = [x for x in self.__links if not x.id in to_delete.links]
-		self.__nodes = [x for x in self.__nodes if not x.id in to_delete.nodes]
-		self.__links_updated()
-		self.__nodes_updated()
-	
+		self.copy_links(self, ~self.word_mask(words))
+
 	# Returns a copy of the lattice with all the links containing any of the
-	# given words removed.
+	# given words removed. Only the remaining nodes and links are copied.
 	def without_words(self, words):
-		result = deepcopy(self)
-		result.remove_words(words)
+		return self.view().without_words(words).copy()
+
+	# Sets the nodes and links of result (which may be this lattice) to those
+	# of this lattice where link_mask is True. Nodes that are left without
+	# incoming links are removed, and then their outgoing links, and so on.
+	def copy_links(self, result, link_mask):
+		deleted_links = ~link_mask
+
+		# Reference count of each node is the number of incoming links, plus
+		# one for the start node. A node is deleted when its reference count
+		# drops to zero, and then its outgoing links are deleted.
+		references = numpy.bincount(self.link_ends, minlength=self.num_nodes())
+		references[self.start_node] += 1
+		referenced = references > 0
+		deleted_nodes = numpy.zeros(self.num_nodes(), dtype=bool)
+		while True:
+			remaining = numpy.bincount(self.link_ends[~deleted_links],
+			                           minlength=self.num_nodes())
+			remaining[self.start_node] += 1
+			new_deleted_nodes = referenced & (remaining == 0)
+			if numpy.array_equal(new_deleted_nodes, deleted_nodes):
+				break
+			deleted_nodes = new_deleted_nodes
+			deleted_links |= deleted_nodes[self.link_starts]
+		deleted_links |= deleted_nodes[self.link_ends]
+
+		end_node = self.end_node
+		if (end_node != -1) and deleted_nodes[end_node]:
+			end_node = -1
+
+		kept_nodes = numpy.flatnonzero(~deleted_nodes)
+		kept_links = ~deleted_links
+		result.__set_arrays(kept_nodes, self.node_times[kept_nodes],
+		                    self.start_node, end_node,
+		                    self.link_ids[kept_links],
+		                    self.link_starts[kept_links],
+		                    self.link_ends[kept_links],
+		                    self.link_words[kept_links],
+		                    self.ac_scores[kept_links],
+		                    self.lm_scores[kept_links])
+
+	# Returns the total score of each link, given the LM scale factor and word
+	# insertion penalty. If the LM scale factor is not given, uses the one in
+	# the lattice header. The penalty is not added to !NULL links. If link_mask
+	# is given, the links where it is False get score -inf.
+	def link_scores(self, lm_scale=None, wip=0, link_mask=None):
+		if lm_scale is None:
+			lm_scale = self.lm_scale
+		result = self.ac_scores + lm_scale * self.lm_scores
+		null_id = self.word_ids.get('!NULL', -1)
+		result += numpy.where(self.link_words != null_id, wip, 0)
+		if link_mask is not None:
+			result[~link_mask] = float('-inf')
+		return result
+
+	# Returns the indices of the links that start from any of the given nodes.
+	def links_from_nodes(self, node_ids):
+		return self.__ranges(self.link_offsets, node_ids)
+
+	# Returns the indices of the links that end in any of the given nodes. The
+	# links are grouped by end node.
+	def links_to_nodes(self, node_ids):
+		return self.in_links[self.__ranges(self.in_offsets, node_ids)]
+
+	# Concatenates the ranges offsets[i]:offsets[i+1] for the given indices.
+	def __ranges(self, offsets, indices):
+		firsts = offsets[indices]
+		counts = offsets[indices + 1] - firsts
+		ends = numpy.cumsum(counts)
+		return numpy.repeat(firsts - ends + counts, counts) + \
+		       numpy.arange(ends[-1] if len(ends) > 0 else 0)
+
+	# Sorts the nodes topologically. Returns a list of arrays of node IDs, so
+	# that every link goes from a node in one array to a node in a later array.
+	# Raises an exception if the lattice contains a cycle. The result is cached
+	# until the links are changed, because removing links does not change it.
+	def topological_waves(self):
+		if self.__waves is not None:
+			return self.__waves
+		in_degrees = numpy.bincount(self.link_ends, minlength=self.num_nodes())
+		wave = numpy.flatnonzero(in_degrees == 0)
+		result = []
+		num_sorted = 0
+		while len(wave) > 0:
+			result.append(wave)
+			num_sorted += len(wave)
+			ends = self.link_ends[self.links_from_nodes(wave)]
+			ends, counts = numpy.unique(ends, return_counts=True)
+			in_degrees[ends] -= counts
+			wave = ends[in_degrees[ends] == 0]
+		if num_sorted < self.num_nodes():
+			raise Exception("The lattice contains a cycle.")
+		self.__waves = result
 		return result
-	
-	# Decrements the reference count of a node. If the reference count drops to
-	# zero, marks the node and all the outgoing links for deletion, and
-	# repeats the process to all the nodes behind the outgoing links. Returns
-	# two lists: the links marked for deletion, and the nodes marked for
-	# deletion.
-	def __unlink(self, node_id):
-		to_delete = self.LNList()
-		if (self.__nodes[node_id].unrefer()):
-			to_delete.nodes.append(node_id)
-			out_links = self.links_from(node_id)
-			for link in out_links:
-				to_delete.links.append(link.id)
-				to_delete.extend(self.__unlink(link.end_node))
-		return to_delete
-	
-	# Keeps links sorted by start node so that we can find all the out links
-	# from given node fast. Has to be called after self.__links is changed.
+
+	# Computes the score of the best path from the start node to each node.
+	# Nodes that are not reachable get score -inf.
+	def forward_scores(self, link_scores, waves=None):
+		if waves is None:
+			waves = self.topological_waves()
+		result = numpy.full(self.num_nodes(), float('-inf'))
+		result[self.start_node] = 0
+		for wave in waves:
+			links = self.links_from_nodes(wave)
+			numpy.maximum.at(result, self.link_ends[links],
+			                 result[self.link_starts[links]] + link_scores[links])
+		return result
+
+	# Computes the score of the best path from each node to the end node.
+	# Nodes that cannot reach the end node get score -inf.
+	def backward_scores(self, link_scores, waves=None):
+		if waves is None:
+			waves = self.topological_waves()
+		result = numpy.full(self.num_nodes(), float('-inf'))
+		result[self.end_node] = 0
+		for wave in reversed(waves):
+			links = self.links_from_nodes(wave)
+			numpy.maximum.at(result, self.link_starts[links],
+			                 result[self.link_ends[links]] + link_scores[links])
+		return result
+
+	# Finds the best path through the lattice using the Viterbi algorithm.
+	# Returns the words on the path, excluding !NULL, and the total score of
+	# the path. If the end node is not reachable, returns None and -inf, like
+	# lattice-tool fails to decode such a lattice. If link_mask is given, only
+	# the links where it is True are used.
+	def viterbi(self, lm_scale=None, wip=0, link_mask=None):
+		if self.end_node == -1:
+			return None, float('-inf')
+		link_scores = self.link_scores(lm_scale, wip, link_mask)
+		node_scores = self.forward_scores(link_scores)
+		score = float(node_scores[self.end_node])
+		if score == float('-inf'):
+			return None, score
+
+		best_links = numpy.full(self.num_nodes(), -1, dtype='int64')
+		self.__update_best_in_links(best_links, node_scores, link_scores,
+		                            numpy.arange(self.num_links()))
+		links = self.__trace_back(best_links, self.end_node)
+		return self.__path_words(links), score
+
+	# Finds for each of the given words the best path through the lattice that
+	# does not contain the word, as viterbi() would find after removing the
+	# word. Returns a list of (words, score) pairs, one for each given word. If
+	# link_mask is given, only the links where it is True are used.
+	#
+	# The forward and backward scores are computed only once. When a word is
+	# excluded, the forward scores change only after the first wave that
+	# contains an end node of a link with the word, and the backward scores
+	# change only before the last wave that contains a start node of such a
+	# link. The forward scores are recomputed for the waves between these, and
+	# the best path is found from the links that cross the last wave, using
+	# the original backward scores after that.
+	def viterbi_excluding(self, words, lm_scale=None, wip=0, link_mask=None):
+		if self.end_node == -1:
+			return [(None, float('-inf')) for x in words]
+		link_scores = self.link_scores(lm_scale, wip, link_mask)
+		waves = self.topological_waves()
+		forward = self.forward_scores(link_scores, waves)
+		backward = self.backward_scores(link_scores, waves)
+		if forward[self.end_node] == float('-inf'):
+			return [(None, float('-inf')) for x in words]
+
+		all_links = numpy.arange(self.num_links())
+		best_in_links = numpy.full(self.num_nodes(), -1, dtype='int64')
+		self.__update_best_in_links(best_in_links, forward, link_scores,
+		                            all_links)
+		best_out_links = numpy.full(self.num_nodes(), -1, dtype='int64')
+		candidates = numpy.flatnonzero(
+			link_scores + backward[self.link_ends] ==
+			backward[self.link_starts])
+		nodes, firsts = numpy.unique(self.link_starts[candidates],
+		                             return_index=True)
+		best_out_links[nodes] = candidates[firsts]
+		wave_ids = numpy.empty(self.num_nodes(), dtype='int64')
+		for wave_id, wave in enumerate(waves):
+			wave_ids[wave] = wave_id
+		start_waves = wave_ids[self.link_starts]
+		end_waves = wave_ids[self.link_ends]
+		wave_in_links = [self.links_to_nodes(x) for x in waves]
+
+		result = []
+		for word in words:
+			excluded = self.link_words == self.word_ids.get(word, -1)
+			# Links that are not on any path from the start node to the end
+			# node do not affect the result.
+			excluded &= forward[self.link_starts] > float('-inf')
+			excluded &= backward[self.link_ends] > float('-inf')
+			if not excluded.any():
+				links = self.__trace_back(best_in_links, self.end_node)
+				result.append((self.__path_words(links),
+				               float(forward[self.end_node])))
+				continue
+
+			first_wave = end_waves[excluded].min()
+			last_wave = start_waves[excluded].max()
+			scores = numpy.where(excluded, float('-inf'), link_scores)
+			node_scores = forward.copy()
+			for wave_id in range(first_wave, last_wave + 1):
+				links = wave_in_links[wave_id]
+				node_scores[waves[wave_id]] = float('-inf')
+				numpy.maximum.at(node_scores, self.link_ends[links],
+				                 node_scores[self.link_starts[links]] + scores[links])
+			best_links = best_in_links.copy()
+			if first_wave <= last_wave:
+				links = numpy.concatenate(wave_in_links[first_wave:last_wave + 1])
+				self.__update_best_in_links(best_links, node_scores, scores,
+				                            links)
+
+			cut = numpy.flatnonzero((start_waves <= last_wave) &
+			                        (end_waves > last_wave))
+			cut_scores = node_scores[self.link_starts[cut]] + scores[cut] + \
+			             backward[self.link_ends[cut]]
+			if (len(cut) == 0) or (cut_scores.max() == float('-inf')):
+				result.append((None, float('-inf')))
+				continue
+			link = cut[cut_scores.argmax()]
+			links = self.__trace_back(best_links, self.link_starts[link])
+			links.append(link)
+			links.extend(self.__trace_forward(best_out_links,
+			                                  self.link_ends[link]))
+			result.append((self.__path_words(links), float(cut_scores.max())))
+		return result
+
+	# Sets the best incoming link of the end node of each of the given links,
+	# given the node scores. The best link is the first link whose start node
+	# score plus link score equals the node score.
+	def __update_best_in_links(self, best_links, node_scores, link_scores,
+	                           links):
+		candidates = links[node_scores[self.link_starts[links]] +
+		                   link_scores[links] ==
+		                   node_scores[self.link_ends[links]]]
+		nodes, firsts = numpy.unique(self.link_ends[candidates],
+		                             return_index=True)
+		best_links[nodes] = candidates[firsts]
+
+	# Returns the links on the best path from the start node to given node.
+	def __trace_back(self, best_links, node_id):
+		result = []
+		while node_id != self.start_node:
+			link = best_links[node_id]
+			result.append(link)
+			node_id = self.link_starts[link]
+		result.reverse()
+		return result
+
+	# Returns the links on the best path from given node to the end node.
+	def __trace_forward(self, best_links, node_id):
+		result = []
+		while node_id != self.end_node:
+			link = best_links[node_id]
+			result.append(link)
+			node_id = self.link_ends[link]
+		return result
+
+	# Returns the words of the given links, excluding !NULL.
+	def __path_words(self, links):
+		words = [self.vocabulary[x] for x in self.link_words[links]]
+		return [x for x in words if x != '!NULL']
+
+	# Computes the index of the first link from each node, so that we can find
+	# all the out links from given node fast, and a similar index of the links
+	# sorted by end node. Has to be called after the link arrays are changed.
 	def __links_updated(self):
-		self.__links.sort(key = lambda x: x.start_node)
-		# There's no key= parameter for bisect functions so we create a separate
-		# list of the start nodes of each link that we use just for searching.
-		self.__start_nodes_of_links = [x.start_node for x in self.__links]
-
-	# Give nodes linear IDs so that they can be indexed by node ID.
-	def __nodes_updated(self):
-		mapping = {}
-		for index, node in enumerate(self.__nodes):
-			mapping[node.id] = index
-			node.id = index
-		for link in self.__links:
-			link.start_node = mapping[link.start_node]
-			link.end_node = mapping[link.end_node]
-		if self.start_node != -1:
-			self.start_node = mapping[self.start_node]
-		if self.end_node != -1:
-			self.end_node = mapping[self.end_node]
+		node_ids = numpy.arange(self.num_nodes() + 1)
+		self.link_offsets = numpy.searchsorted(self.link_starts, node_ids)
+		self.in_links = numpy.argsort(self.link_ends, kind='stable')
+		self.in_offsets = numpy.searchsorted(self.link_ends[self.in_links],
+		                                     node_ids)
+		self.__waves = None
@@ -18,6 +18,17 @@
 # - The counts in the entire training text are collected only once. Then we
 #   proceed by collecting the counts of each individual segment at a time,
 #   and subtracting them from the counts of the entire training text.
+# - The log probability given by the entire training text is computed once.
+#   Only the words that occur in a page change the log probability when the
+#   page is removed, so scoring a page takes time proportional to the length
+#   of the page, not the size of the vocabulary. Pages are processed in
+#   batches using NumPy, so that the counts of a batch form a sparse matrix,
+#   whose rows are scored using array operations.
+# - With --jobs, the pages are counted and scored in parallel processes. The
+#   pages file is memory-mapped, and the processes are forked after the count
+#   arrays have been created, so they share the pages and the counts without
+#   copying. Each process is given a range of pages, and the scores are
+#   written in the original order.
 #
 # Author: Seppo Enarvi
 # http://users.marjaniemi.com/seppo/
@@ -25,7 +36,9 @@
 import argparse
 import sys
 import re
-import math
+import io
+import multiprocessing
+import numpy
 from pages import *
 from filetypes import TextFileType
 
@@ -48,10 +61,126 @@ def read_unigram_counts(file, vocab=None):
 			total += line_total
 	return counts, total
 
+# Converts a text into a list of word IDs. Words that are not in the vocabulary
+# are omitted. Returns the IDs and the total number of words.
+def text_to_ids(text, word_ids):
+	words = text.split()
+	return [word_ids[word] for word in words if word in word_ids], len(words)
+
+# Counts the vocabulary words in a pages file. Returns an array of counts
+# indexed by word ID, and the total number of words.
+def read_id_counts(file, word_ids):
+	counts = numpy.zeros(len(word_ids), dtype='int64')
+	total = 0
+	ids = []
+	for line in file:
+		if not line.startswith('###### '):
+			line_ids, line_total = text_to_ids(line, word_ids)
+			ids.extend(line_ids)
+			total += line_total
+			if len(ids) > 1000000:
+				counts += numpy.bincount(ids, minlength=len(word_ids))
+				ids = []
+	counts += numpy.bincount(numpy.array(ids, dtype='int64'), minlength=len(word_ids))
+	return counts, total
+
+# Computes the log probability of the in-domain text, when each of a batch of
+# pages is removed from the training data.
+#
+# The page counts form a sparse matrix, whose nonzero elements are given in
+# three arrays: page index, word ID, and count. The log probability without a
+# page is the log probability with the entire training data, plus a change for
+# each word that occurs in the page, minus the change in normalization.
+class PageScorer:
+	def __init__(self, id_counts, nds_counts, nds_total):
+		self.id_counts = id_counts
+		self.nds_counts = nds_counts
+		self.nds_total = nds_total
+		# Words that don't occur in the training data are ignored.
+		found = nds_counts > 0
+		self.nds_logcounts = numpy.zeros(len(nds_counts))
+		self.nds_logcounts[found] = numpy.log(nds_counts[found])
+		self.id_total = id_counts[found].sum()
+		self.base_logprob = (id_counts[found] * self.nds_logcounts[found]).sum()
+
+	def score(self, page_indices, word_ids, page_counts, page_totals):
+		num_pages = len(page_totals)
+		sub_counts = self.nds_counts[word_ids] - page_counts
+		invalid = numpy.bincount(page_indices, sub_counts < 1, num_pages) > 0
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			changes = numpy.log(numpy.maximum(sub_counts, 1)) - self.nds_logcounts[word_ids]
+			changes *= self.id_counts[word_ids]
+			logprobs = self.base_logprob + numpy.bincount(page_indices, changes, num_pages)
+			logprobs -= self.id_total * numpy.log(self.nds_total - page_totals)
+		logprobs[invalid] = -sys.float_info.max
+		return logprobs
+
+# Scores a batch of pages and writes the scores.
+def write_scores(scorer, uris, page_ids, page_totals, output_file):
+	if not uris:
+		return
+	page_indices = numpy.repeat(numpy.arange(len(page_ids)), [len(x) for x in page_ids])
+	word_ids = numpy.fromiter((x for ids in page_ids for x in ids), dtype='int64', count=len(page_indices))
+	# Combine the page index and word ID into one key for counting.
+	keys, page_counts = numpy.unique(page_indices * len(scorer.nds_counts) + word_ids, return_counts=True)
+	page_indices, word_ids = numpy.divmod(keys, len(scorer.nds_counts))
+	logprobs = scorer.score(page_indices, word_ids, page_counts, numpy.array(page_totals))
+	for uri, logprob in zip(uris, logprobs):
+		output_file.write('###### ' + uri + '\n')
+		output_file.write(str(float(logprob)) + '\n')
+
+# Returns the text before the first page header of a memory-mapped pages file.
+# The text does not belong to any page, but read_id_counts() counts it in the
+# training data.
+def preamble_text(mapping):
+	if mapping[:7] == b'###### ':
+		return ''
+	end = mapping.find(b'\n###### ')
+	end = len(mapping) if end == -1 else end + 1
+	return mapping[:end].decode('utf-8')
+
+# Worker functions for --jobs. The workers read the pages from a memory-mapped
+# file using the page byte ranges in page_offsets.
+def page_text(index):
+	uri, offset, length = page_offsets[index]
+	return uri, pages_mapping[offset:offset+length].decode('utf-8')
+
+def count_pages(page_range):
+	counts = numpy.zeros(len(word_ids), dtype='int64')
+	total = 0
+	ids = []
+	for index in range(*page_range):
+		uri, text = page_text(index)
+		page_ids, page_total = text_to_ids(text, word_ids)
+		ids.extend(page_ids)
+		total += page_total
+	counts += numpy.bincount(numpy.array(ids, dtype='int64'), minlength=len(word_ids))
+	return counts, total
+
+def score_pages(indices):
+	uris = []
+	page_ids = []
+	page_totals = []
+	for index in indices:
+		uri, text = page_text(index)
+		ids, total = text_to_ids(text, word_ids)
+		uris.append(uri)
+		page_ids.append(ids)
+		page_totals.append(total)
+	output = io.StringIO()
+	write_scores(scorer, uris, page_ids, page_totals, output)
+	return output.getvalue()
+
+def split_range(length, num_parts):
+	bounds = numpy.linspace(0, length, num_parts + 1).astype(int)
+	return [(bounds[i], bounds[i+1]) for i in range(num_parts) if bounds[i] < bounds[i+1]]
+
 parser = argparse.ArgumentParser()
 parser.add_argument('pages', type=TextFileType('r'), help='non-domain-specific input text pages')
 parser.add_argument('idtext', type=TextFileType('r'), help='in-domain development text')
 parser.add_argument('--scores', type=TextFileType('w'), default='-', help='output scores file')
+parser.add_argument('-j', '--jobs', type=int, default=None, help='number of parallel processes (requires an uncompressed pages file)')
+parser.add_argument('--batch-size', type=int, default=10000, help='number of pages to score at a time')
 parser.add_argument('-B', '--batch', type=int, dest='num_batches', default=1, help='number of batches to split the job into')
 parser.add_argument('-I', '--bindex', type=int, dest='batch_index', default=1, help='index of this batch, starting from 1')
 args = parser.parse_args()
@@ -62,40 +191,66 @@ if args.batch_index > args.num_batches:
 if args.batch_index < 1:
 	sys.stderr.write("Batch indices start from 1.\n")
 	sys.exit(2)
+if (args.jobs is not None) and (args.jobs < 1):
+	sys.stderr.write("The number of parallel processes has to be at least 1.\n")
+	sys.exit(2)
 
 id_counts, _ = read_unigram_counts(args.idtext)
 args.idtext.close()
 
-vocabulary = id_counts.keys()
+vocabulary = list(id_counts.keys())
 sys.stderr.write('%d words in in-domain text.\n' % len(vocabulary))
+word_ids = dict((word, index) for index, word in enumerate(vocabulary))
+id_counts = numpy.array([id_counts[word] for word in vocabulary], dtype='d')
+
+if args.jobs is None:
+	nds_counts, nds_total = read_id_counts(args.pages, word_ids)
+	sys.stderr.write('%d in-domain words in training data.\n' % numpy.count_nonzero(nds_counts))
+	scorer = PageScorer(id_counts, nds_counts, nds_total)
+
+	args.pages.seek(0)
+	page_index = -1
+	uris = []
+	page_ids = []
+	page_totals = []
+	for page in read_pages(args.pages):
+		page_index += 1
+		if page_index % args.num_batches + 1 != args.batch_index:
+			continue
+		ids, total = text_to_ids(page.content(), word_ids)
+		uris.append(page.uri())
+		page_ids.append(ids)
+		page_totals.append(total)
+		if len(uris) >= args.batch_size:
+			write_scores(scorer, uris, page_ids, page_totals, args.scores)
+			uris = []
+			page_ids = []
+			page_totals = []
+	write_scores(scorer, uris, page_ids, page_totals, args.scores)
+
+else:
+	pages_mapping = map_file(args.pages)
+	if pages_mapping is None:
+		sys.stderr.write("--jobs requires an uncompressed pages file.\n")
+		sys.exit(2)
+	page_offsets = mapped_page_offsets(pages_mapping)
+	context = multiprocessing.get_context('fork')
+
+	preamble_ids, nds_total = text_to_ids(preamble_text(pages_mapping), word_ids)
+	nds_counts = numpy.bincount(numpy.array(preamble_ids, dtype='int64'), minlength=len(word_ids))
+	with context.Pool(args.jobs) as pool:
+		page_ranges = split_range(len(page_offsets), args.jobs * 8)
+		for counts, total in pool.imap(count_pages, page_ranges):
+			nds_counts += counts
+			nds_total += total
+	sys.stderr.write('%d in-domain words in training data.\n' % numpy.count_nonzero(nds_counts))
+	scorer = PageScorer(id_counts, nds_counts, nds_total)
 
-nds_counts, nds_total = read_unigram_counts(args.pages, vocabulary)
-vocabulary = [word for word in vocabulary if word in nds_counts]
-sys.stderr.write('%d in-domain words in training data.\n' % len(vocabulary))
-
-args.pages.seek(0)
-page_index = -1
-for page in read_pages(args.pages):
-	page_index += 1
-	if page_index % args.num_batches + 1 != args.batch_index:
-		continue
-	uri = page.uri()
-	page_counts, page_total = add_unigram_counts(page.content(), dict(), vocabulary)
-	sub_total = nds_total - page_total
-	logprob = 0
-	for word in vocabulary:
-		sub_count = nds_counts[word]
-		if word in page_counts:
-			sub_count -= page_counts[word]
-		if sub_count < 1:
-			logprob = -sys.float_info.max
-			break
-		else:
-			id_count = id_counts[word]
-			try:
-				logprob += math.log(float(sub_count) / sub_total) * id_count
-			except ValueError:
-				sys.stderr.write('At page "%s":\n' % uri)
-				sys.stderr.write('Error computing log(%d / %d) * %d.\n' % (sub_count, sub_total, id_count))
-	args.scores.write(page.header())
-	args.scores.write(str(logprob) + '\n')
+	# mapped_page_offsets() skips empty pages like read_pages(), so the pages
+	# of this batch are the same as in the sequential mode.
+	indices = list(range(len(page_offsets)))[args.batch_index-1::args.num_batches]
+	with context.Pool(args.jobs) as pool:
+		page_ranges = split_range(len(indices), (len(indices) + args.batch_size - 1) // args.batch_size)
+		index_lists = [indices[start:end] for start, end in page_ranges]
+		for scores in pool.imap(score_pages, index_lists):
+			args.scores.write(scores)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Scoring functions that can be used with score-pages.py --python. The ARPA
+# language model is read by initialize(), which score-pages.py calls once in
+# each worker process, e.g.
+#
+#   score-pages.py --python --scorer-arg=model.arpa lmscorer:perplexity input.pages
+#
+# The model can also be in the binary format written by arpa-to-binary.py,
+# which is faster to load. Requires ArpaLM.py from scoring-tools.
+
+import sys
+import math
+from contextlib import redirect_stdout
+from ArpaLM import ArpaLM
+
+lm = None
+
+def initialize(lm_path):
+	global lm
+	# ArpaLM prints progress to standard output, which may be the scores file.
+	with redirect_stdout(sys.stderr):
+		lm = ArpaLM(lm_path)
+
+# Returns the natural logarithm of the probability of the text and the number
+# of words that were scored. Each line is a sentence. Out-of-vocabulary words
+# are not scored.
+def text_logprob(text):
+	sentences = [lm.word_ids(['<s>'] + line.split() + ['</s>'])
+	             for line in text.splitlines() if line.split()]
+	logprobs = lm.batch_prob(sentences)
+	logprobs = logprobs[logprobs > float('-inf')]
+	return float(logprobs.sum()), len(logprobs)
+
+def logprob(text):
+	return text_logprob(text)[0]
+
+def perplexity(text):
+	logprob_sum, num_words = text_logprob(text)
+	if num_words == 0:
+		return float('inf')
+	return math.exp(-logprob_sum / num_words)
@@ -7,7 +7,13 @@
 # http://users.marjaniemi.com/seppo/
 
 import sys
+import io
+import re
+import os
 import string
+import mmap
+import struct
+import gzip
 
 class Page:
 	def __init__(self, uri=None, content=''):
@@ -32,6 +38,9 @@ class Page:
 		self.__content += x
 
 
+# A page whose content is read from disk when needed. The pointers are
+# (source, offset, length) tuples, where source is a memory-mapped file, or a
+# binary file object if the file could not be mapped (e.g. it is compressed).
 class DiskPage:
 	def __init__(self, uri=None):
 		self.__uri = uri
@@ -51,18 +60,59 @@ class DiskPage:
 		return '###### ' + self.__uri + '\n'
 
 	def content(self):
-		result = ''
-		for file, start_offset, length in self.__pointers:
-			file.seek(start_offset)
-			result += file.read(length)
-		return result
+		return b''.join(self.content_views()).decode('utf-8')
+
+	# Returns the content as a list of bytes-like objects. The content of
+	# memory-mapped pages is not copied.
+	def content_views(self):
+		return [read_range(source, offset, length)
+		        for source, offset, length in self.__pointers]
+
+	# Writes the content to a binary or text file. Text files are flushed and
+	# the content is written directly to the underlying binary buffer, if
+	# there is one.
+	def write_content(self, output_file):
+		if isinstance(output_file, io.TextIOBase):
+			if not hasattr(output_file, 'buffer'):
+				output_file.write(self.content())
+				return
+			output_file.flush()
+			output_file = output_file.buffer
+		for view in self.content_views():
+			output_file.write(view)
 
 	def pointers(self):
 		return self.__pointers
 	
 	def add_pages(self, x):
 		self.__pointers.extend(x)
-	
+
+
+# Maps a file into memory for reading. Returns None if the file cannot be
+# mapped.
+def map_file(file):
+	try:
+		fileno = file.fileno()
+	except (AttributeError, io.UnsupportedOperation):
+		return None
+	if hasattr(file, 'buffer') and isinstance(file.buffer, gzip.GzipFile):
+		return None
+	if isinstance(file, gzip.GzipFile):
+		return None
+	try:
+		if os.fstat(fileno).st_size == 0:
+			return b''
+		return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):
+		return None
+
+# Returns a range of bytes from a memory-mapped or binary file.
+def read_range(source, offset, length):
+	if isinstance(source, mmap.mmap):
+		return memoryview(source)[offset:offset+length]
+	source.seek(offset)
+	return source.read(length)
+
 
 # Reads all the pages from a file.
 def read_pages(file, fragments=True):
@@ -82,35 +132,50 @@ def read_pages(file, fragments=True):
 	if not page.empty():
 		yield page
 
-# Returns pointers to all the pages in a file.
+# Returns pointers to all the pages in a file. The file is memory-mapped if
+# possible.
 def read_page_pointers(file, fragments=True):
-	page = None
-	start_offset = 0
-	length = 0
-
-	# "for line in file" loop doesn't allow file.tell().
-	while True:
-		line = file.readline()
-		if not line: break
+	source = map_file(file)
+	if source is not None:
+		offsets = mapped_page_offsets(source)
+	else:
+		source = file.buffer if hasattr(file, 'buffer') else file
+		source.seek(0)
+		offsets = read_page_offsets(source)
 
-		if line.startswith('###### '):
-			if (page is not None) and (length > 0):
-				page.add_pages([(file, start_offset, length)])
-				yield page
-			uri = line[7:].rstrip()
-			if not fragments:
-				end = uri.find('#')
-				if end != -1:
-					uri = uri[:end]
-			page = DiskPage(uri)
-			start_offset = file.tell()
-			length = 0
-		else:
-			length += len(line)
-	if (page is not None) and (length > 0):
-		page.add_pages([(file, start_offset, length)])
+	for uri, offset, length in offsets:
+		if not fragments:
+			end = uri.find('#')
+			if end != -1:
+				uri = uri[:end]
+		page = DiskPage(uri)
+		page.add_pages([(source, offset, length)])
 		yield page
 
+# Writes a page to a persistent scoring process (score-pages.py --workers). The
+# page is framed by a line that contains the length of the UTF-8 encoded content
+# in bytes.
+def write_framed_page(output_file, content):
+	if isinstance(content, str):
+		content = content.encode('utf-8')
+	output_file.write(b'%d\n' % len(content))
+	output_file.write(content)
+	output_file.flush()
+
+# Reads framed pages from a binary file, until end of file. Can be used in a
+# scoring program that is started by score-pages.py --workers. The program
+# should write the score on one line, and flush the output, after each page.
+def read_framed_pages(input_file):
+	while True:
+		line = input_file.readline()
+		if not line:
+			break
+		length = int(line)
+		content = input_file.read(length)
+		if len(content) != length:
+			raise IOError("Unexpected end of file while reading a framed page.")
+		yield content.decode('utf-8')
+
 # Reads all the scores into a dictionary.
 def read_scores(file):
 	scores = {}
@@ -159,3 +224,211 @@ def write_matching_content(input_file, output_file, match_uri, match_fragments=F
 		else:
 			if not match:
 				output_file.write(line)
+
+
+# Returns the byte ranges of all the pages in a binary mode file, as a list of
+# (uri, offset, length) tuples. Pages that contain only whitespace are skipped,
+# like in read_pages().
+def read_page_offsets(file):
+	result = []
+	uri = None
+	start_offset = 0
+	offset = 0
+	blank = True
+	for line in file:
+		if line.startswith(b'###### '):
+			if (uri is not None) and (not blank):
+				result.append((uri, start_offset, offset - start_offset))
+			uri = line[7:].rstrip().decode('utf-8')
+			offset += len(line)
+			start_offset = offset
+			blank = True
+		else:
+			offset += len(line)
+			if line.strip():
+				blank = False
+	if (uri is not None) and (not blank):
+		result.append((uri, start_offset, offset - start_offset))
+	return result
+
+# Matches a character that is not whitespace, as defined by Page.empty().
+NONBLANK_RE = re.compile(rb'[^ \t\n\r\x0b\x0c]')
+
+
+# Returns the byte ranges of all the pages in a memory-mapped file. The header
+# lines are searched using mmap.find(), without splitting the file into lines.
+# Pages that contain only whitespace are skipped, like in read_pages().
+def mapped_page_offsets(mapping):
+	result = []
+	size = len(mapping)
+	if mapping[:7] == b'###### ':
+		header_pos = 0
+	else:
+		header_pos = mapping.find(b'\n###### ')
+		if header_pos != -1:
+			header_pos += 1
+	while header_pos != -1:
+		uri_end = mapping.find(b'\n', header_pos)
+		if uri_end == -1:
+			uri_end = size
+		uri = bytes(mapping[header_pos+7:uri_end]).rstrip().decode('utf-8')
+		start_offset = min(uri_end + 1, size)
+		next_pos = mapping.find(b'\n###### ', uri_end)
+		if next_pos == -1:
+			end_offset = size
+			header_pos = -1
+		else:
+			end_offset = next_pos + 1
+			header_pos = next_pos + 1
+		if NONBLANK_RE.search(mapping, start_offset, end_offset):
+			result.append((uri, start_offset, end_offset - start_offset))
+	return result
+
+
+# The page index file starts with a magic string and the size of the pages file
+# that it was created from. Then follows a record for each page: byte offset and
+# length of the content, length of the URI, and the UTF-8 encoded URI.
+INDEX_MAGIC = b'PAGEIDX2'
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_RECORD = struct.Struct('<QQH')
+
+def page_index_path(pages_path):
+	return pages_path + '.index'
+
+def write_page_index(index_file, offsets, pages_size):
+	index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, pages_size))
+	for uri, offset, length in offsets:
+		uri = uri.encode('utf-8')
+		index_file.write(INDEX_RECORD.pack(offset, length, len(uri)))
+		index_file.write(uri)
+
+# Reads a page index. Returns None if the index was not created from a pages
+# file of the given size.
+def read_page_index(index_file, pages_size):
+	data = index_file.read()
+	if len(data) < INDEX_HEADER.size:
+		return None
+	magic, size = INDEX_HEADER.unpack_from(data)
+	if (magic != INDEX_MAGIC) or (size != pages_size):
+		return None
+	result = []
+	pos = INDEX_HEADER.size
+	while pos < len(data):
+		offset, length, uri_length = INDEX_RECORD.unpack_from(data, pos)
+		pos += INDEX_RECORD.size
+		uri = data[pos:pos+uri_length].decode('utf-8')
+		pos += uri_length
+		result.append((uri, offset, length))
+	return result
+
+# Returns the byte ranges of all the pages in a pages file. Reads them from the
+# index file next to the pages file if it is up to date. Otherwise scans the
+# pages file and tries to write the index file.
+def page_offsets(pages_path):
+	index_path = page_index_path(pages_path)
+	pages_size = os.path.getsize(pages_path)
+	if os.path.exists(index_path) and \
+	   (os.path.getmtime(index_path) >= os.path.getmtime(pages_path)):
+		with open(index_path, 'rb') as index_file:
+			result = read_page_index(index_file, pages_size)
+		if result is not None:
+			return result
+
+	sys.stderr.write("Indexing %s.\n" % pages_path)
+	with open_binary(pages_path) as pages_file:
+		mapping = map_file(pages_file)
+		if mapping is not None:
+			result = mapped_page_offsets(mapping)
+		else:
+			result = read_page_offsets(pages_file)
+	try:
+		with open(index_path, 'wb') as index_file:
+			write_page_index(index_file, result, pages_size)
+	except IOError as e:
+		sys.stderr.write("Unable to write page index: %s\n" % e)
+	return result
+
+def open_binary(path):
+	if path.endswith('.gz'):
+		return gzip.open(path, 'rb')
+	return open(path, 'rb')
+
+
+# Provides random access to the pages in one or more pages files. The pages are
+# identified by URI. The content of pages that have the same URI (or the same
+# URI before the fragment identifier, if fragments=False) is concatenated. The
+# pages are iterated in the order in which they first appear in the files. The
+# files are memory-mapped, unless they are compressed. Compressed files cannot
+# be accessed in random order efficiently, because a seek in a gzip file
+# decompresses the file from the beginning, so the input should be
+# uncompressed, or loaded into memory. Standard input cannot be indexed at all.
+class PageStore:
+	def __init__(self, paths, fragments=True):
+		self.__paths = list(paths)
+		self.__files = []
+		self.__sources = []
+		self.__pointers = dict()
+		for path in self.__paths:
+			# The name of a file object that reads standard input is "<stdin>".
+			if path in ('-', '<stdin>'):
+				sys.stderr.write("Pages cannot be read from standard input in random order. Give the pages in a file, or load them into memory (--in-memory).\n")
+				sys.exit(2)
+			if path.endswith('.gz'):
+				sys.stderr.write("Warning: %s is compressed and has to be decompressed from the beginning every time a page is read. Decompress the file or use --in-memory.\n" % path)
+			offsets = page_offsets(path)
+			file_index = len(self.__files)
+			self.__open_file(path)
+			for uri, offset, length in offsets:
+				if not fragments:
+					end = uri.find('#')
+					if end != -1:
+						uri = uri[:end]
+				if uri in self.__pointers:
+					self.__pointers[uri].append((file_index, offset, length))
+				else:
+					self.__pointers[uri] = [(file_index, offset, length)]
+
+	def __open_file(self, path):
+		file = open_binary(path)
+		self.__files.append(file)
+		source = map_file(file)
+		if source is None:
+			source = file
+		self.__sources.append(source)
+
+	def __len__(self):
+		return len(self.__pointers)
+
+	def __contains__(self, uri):
+		return uri in self.__pointers
+
+	def __iter__(self):
+		return iter(self.__pointers)
+
+	def page(self, uri):
+		result = DiskPage(uri)
+		result.add_pages([(self.__sources[file_index], offset, length)
+		                  for file_index, offset, length in self.__pointers[uri]])
+		return result
+
+	def content(self, uri):
+		return self.page(uri).content()
+
+	def write_content(self, uri, output_file):
+		self.page(uri).write_content(output_file)
+
+	# Opens the files again. Has to be called in a forked process before reading
+	# any pages, because file objects that are not memory-mapped share the file
+	# offset with the parent process. The inherited file objects are left open,
+	# since closing them could flush state that the parent process relies on.
+	def reopen(self):
+		self.__files = []
+		self.__sources = []
+		for path in self.__paths:
+			self.__open_file(path)
+
+	def close(self):
+		for file in self.__files:
+			file.close()
+		self.__files = []
+		self.__sources = []
@@ -6,10 +6,11 @@
 # Author: Seppo Enarvi
 # http://users.marjaniemi.com/seppo/
 
-import sys
 import re
-import tempfile
-import subprocess
+import numpy
+from array import array
+from collections import Counter
+from ngramcounts import NGramCounts
 
 
 def read_word_segmentations(input_file):
@@ -30,98 +31,314 @@ def read_word_segmentations(input_file):
 	return wsegs
 
 
-def word_perplexity(train_text, devel_text, vocabulary=None):
-	lm_file = tempfile.NamedTemporaryFile(mode='w+', encoding="utf-8")
-	command = [ 'ngram-count',
-			'-order', '2',
-			'-wbdiscount1', '-wbdiscount2',
-			'-interpolate1', '-interpolate2',
-			'-text', train_text,
-			'-lm', lm_file.name ]
-	if vocabulary is not None:
-		command.extend(['-unk', '-vocab', vocabulary])
-	subprocess.check_call(command)
-	
-	command = [ 'ngram',
-			'-order', '2',
-			'-lm', lm_file.name,
-			'-ppl', devel_text]
-	if vocabulary is not None:
-		command.extend(['-unk', '-vocab', vocabulary])
-	output = subprocess.check_output(command).decode('utf-8').splitlines()
-	matches = re.search(b'(\d+) OOVs', output[0])
-	if matches:
-		num_oovs = int(matches.group(1))
-	else:
-		sys.stderr.write("Unable to parse OOVs from:\n")
-		sys.stderr.write(output[0])
-		sys.stderr.write("\n")
-		sys.exit(1)
-	matches = re.search(b'ppl= ?(\d+(.\d+)?)', output[1])
-	if matches:
-		perplexity = float(matches.group(1))
-	else:
-		sys.stderr.write("Unable to parse ppl from:\n")
-		sys.stderr.write(output[1])
-		sys.stderr.write("\n")
-		sys.exit(1)
-	return perplexity, num_oovs
-
-
-# Segments text according to given word segmentation, to be used as subword
-# language model training data.
-def segment_text(input_file, output_file, wsegs):
-	for line in input_file:
-		line = line.strip()
-		words = line.split()
-	
-		output_file.write("<s> <w> ")
-		for word in words:
-			subwords = wsegs[word]
-			for sw in subwords:
-				output_file.write(sw)
-				output_file.write(" ")
-			output_file.write("<w> ")
-		output_file.write("</s>\n")
-
-
-def subword_perplexity(train_text, devel_text, wsegs, order=3):
-	if wsegs is None:
-		segmented_train_text = train_text
-		segmented_devel_text = devel_text
-	else:
-		segmented_train_text = tempfile.NamedTemporaryFile(mode='w+', encoding="utf-8")
-		segment_text(train_text, segmented_train_text, wsegs)
-		segmented_devel_text = tempfile.NamedTemporaryFile(mode='w+', encoding="utf-8")
-		segment_text(devel_text, segmented_devel_text, wsegs)
-	
-	lm_file = tempfile.NamedTemporaryFile(mode='w+', encoding="utf-8")
-	command = [ 'ngram-count',
-			'-order', str(order),
-			'-wbdiscount1', '-wbdiscount2', '-wbdiscount3',
-			'-interpolate1', '-interpolate2', '-interpolate3',
-			'-text', segmented_train_text.name,
-			'-lm', lm_file.name ]
-	subprocess.check_call(command)
-	
-	command = [ 'perplexity',
-			'-a', lm_file.name,
-			'-t', '2',
-			segmented_devel_text.name,
-			'-']
-	output = subprocess.check_output(command, stderr=subprocess.STDOUT).decode('utf-8')
-	matches = re.search('^Dropped:\s*(\d+) UNKS', output, re.MULTILINE)
-	if matches:
-		num_oovs = int(matches.group(1))
-	else:
-		sys.stderr.write("Unable to parse UNKS from:\n")
-		sys.stderr.write(output)
-		sys.exit(1)
-	matches = re.search('^Perplexity (\d+(.\d+)?)', output, re.MULTILINE)
-	if matches:
-		perplexity = float(matches.group(1))
-	else:
-		sys.stderr.write("Unable to parse Perplexity from:\n")
-		sys.stderr.write(output)
-		sys.exit(1)
-	return perplexity, num_oovs
+# Segments a line of text according to given word segmentation. Returns a list
+# of subwords, with <w> tokens at word boundaries, excluding the sentence start
+# and end tokens. Words that are not found in the segmentation are not
+# segmented.
+def segment_line(line, wsegs):
+	result = ['<w>']
+	for word in line.split():
+		result.extend(wsegs.get(word, [word]))
+		result.append('<w>')
+	return result
+
+
+# Returns the default minimum counts of n-grams that SRILM ngram-count includes
+# in a model (-gt1min, -gt2min, ...). N-grams of order 3 and higher that occur
+# only once are excluded.
+def srilm_min_counts(order):
+	return [1, 1][:order] + [2] * max(order - 2, 0)
+
+
+# Computes the log probability that an interpolated Witten-Bell n-gram language
+# model gives to an evaluation text. Each line of the text is a sentence.
+#
+# The model is not estimated explicitly. Instead, the counts from the training
+# text are collected with add_counts(), and only the statistics that are needed
+# for the evaluation text are kept: the count of each n-gram that has a history
+# that occurs in the evaluation text, and for each such history, the total
+# count and the number of distinct words that follow it. Counts can also be
+# subtracted, so that e.g. the effect of removing a page from the training text
+# can be computed without collecting the counts again.
+#
+# Out-of-vocabulary words in the evaluation text are not scored. If a
+# vocabulary is given, it is used for the uniform zerogram distribution, and
+# words outside the vocabulary are out of vocabulary. Otherwise the vocabulary
+# consists of the words in the training data. If open_vocabulary is True, words
+# outside the vocabulary are mapped to <unk>, both in the training and in the
+# evaluation text.
+#
+# The first initial_history_length tokens of each sentence, including the
+# sentence start <s>, are used as the initial history, and are not scored, like
+# in variKN perplexity -t. Subword models use <s> <w> as the initial history, so
+# that the word boundary after the sentence start is not scored.
+#
+# The probabilities are the same as those of a model estimated by SRILM
+# ngram-count with -wbdiscount and -interpolate options at every order. If
+# min_counts is given, n-grams of order n that occur less than min_counts[n-1]
+# times are excluded from the model, and their probability is given by the
+# backoff weights, as in SRILM. The probabilities are computed using NumPy
+# array operations.
+class WittenBellEvaluator:
+	def __init__(self, text, order, vocabulary=None, open_vocabulary=False, min_counts=None, initial_history_length=1):
+		self.__order = order
+		self.__counts = NGramCounts()
+		if (min_counts is not None) and any(x > 1 for x in min_counts):
+			self.__min_counts = list(min_counts) + [min_counts[-1]] * (order - len(min_counts))
+		else:
+			self.__min_counts = None
+
+		if vocabulary is not None:
+			vocabulary = set(vocabulary)
+			vocabulary.discard('<s>')
+			vocabulary.add('</s>')
+			if open_vocabulary:
+				vocabulary.add('<unk>')
+				self.__unk_vocabulary = vocabulary | {'<s>'}
+			else:
+				self.__unk_vocabulary = None
+		elif open_vocabulary:
+			raise ValueError("WittenBellEvaluator: Open vocabulary requires a vocabulary.")
+		else:
+			self.__unk_vocabulary = None
+
+		events = Counter()
+		for line in text.splitlines():
+			words = sentence_words(line)
+			if words is None:
+				continue
+			if self.__unk_vocabulary is not None:
+				words = [x if x in vocabulary else '<unk>' for x in words]
+			history = ('<s>',) + tuple(words[:initial_history_length - 1])
+			history = history[-(order - 1):] if order > 1 else ()
+			for word in words[initial_history_length - 1:] + ['</s>']:
+				events[(history, word)] += 1
+				history = (history + (word,))[-(order - 1):] if order > 1 else ()
+		self.__events = list(events.keys())
+		self.__num_events = len(events)
+		self.__weights = numpy.array(list(events.values()), dtype='d')
+
+		# For each order, maps the n-grams and histories to event indices.
+		self.__ngram_events = [dict() for n in range(order)]
+		self.__history_events = [dict() for n in range(order)]
+		for event_index, (history, word) in enumerate(self.__events):
+			for n in range(1, order + 1):
+				if n > len(history) + 1:
+					break
+				ngram_history = history[len(history) - (n - 1):]
+				ngram = ngram_history + (word,)
+				self.__ngram_events[n-1].setdefault(ngram, []).append(event_index)
+				self.__history_events[n-1].setdefault(ngram_history, []).append(event_index)
+		for n in range(order):
+			for key, value in self.__ngram_events[n].items():
+				self.__ngram_events[n][key] = numpy.array(value)
+			for key, value in self.__history_events[n].items():
+				self.__history_events[n][key] = numpy.array(value)
+
+		self.__ngram_counts = numpy.zeros((order, self.__num_events))
+		self.__history_totals = numpy.zeros((order, self.__num_events))
+		self.__history_types = numpy.zeros((order, self.__num_events))
+		self.__unigram_types = 0
+
+		if vocabulary is not None:
+			self.__vocabulary_size = len(vocabulary)
+			self.__in_vocabulary = numpy.array(
+				[word in vocabulary for history, word in self.__events])
+		else:
+			self.__vocabulary_size = None
+			self.__in_vocabulary = None
+
+		# When some n-grams are excluded, the backoff weights depend on all
+		# the n-grams that follow the histories of the evaluation text. These
+		# n-grams and their lower order suffixes are stored in a table for
+		# each order. Each table entry has a count, a history ID, and the index
+		# of the suffix in the lower order table. For each event and order,
+		# the table entry of the n-gram and the ID of its history are stored,
+		# or -1 if the n-gram does not exist in the table.
+		if self.__min_counts is not None:
+			self.__entries = [dict() for n in range(order)]
+			self.__entry_counts = [array('d') for n in range(order)]
+			self.__entry_histories = [array('q') for n in range(order)]
+			self.__entry_lowers = [array('q') for n in range(order)]
+			self.__history_ids = [dict() for n in range(order)]
+			self.__event_entries = numpy.full((order, self.__num_events), -1)
+			self.__event_histories = numpy.full((order, self.__num_events), -1)
+
+	# Adds n-gram counts from training text to the model. The counts should
+	# contain all the n-grams up to the model order, collected from text with
+	# sentence boundaries (NGramCounts.from_text() with sentence_boundaries).
+	# If sign is -1, subtracts the counts.
+	def add_counts(self, counts, sign=1):
+		vocabulary = self.__unk_vocabulary
+		for ngram, count in counts.items():
+			n = len(ngram)
+			if (n > self.__order) or (ngram[-1] == '<s>'):
+				continue
+			if vocabulary is not None:
+				ngram = tuple(x if x in vocabulary else '<unk>' for x in ngram)
+			history = ngram[:-1]
+			history_events = self.__history_events[n-1].get(history)
+			if (history_events is None) and (n > 1):
+				continue
+			new_count = self.__counts.add(ngram, sign * count)
+			old_count = new_count - sign * count
+			type_change = (new_count > 0) - (old_count > 0)
+			if n == 1:
+				self.__unigram_types += type_change
+			if history_events is not None:
+				self.__history_totals[n-1][history_events] += sign * count
+				if type_change != 0:
+					self.__history_types[n-1][history_events] += type_change
+			ngram_events = self.__ngram_events[n-1].get(ngram)
+			if ngram_events is not None:
+				self.__ngram_counts[n-1][ngram_events] += sign * count
+			if self.__min_counts is not None:
+				self.__entry_counts[n-1][self.__entry(ngram)] = new_count
+
+	# Returns the index of an n-gram in the table of its order, adding the
+	# n-gram and its history, and recursively its suffix, if necessary.
+	def __entry(self, ngram):
+		n = len(ngram)
+		result = self.__entries[n-1].get(ngram)
+		if result is not None:
+			return result
+
+		history = ngram[:-1]
+		history_id = self.__history_ids[n-1].get(history)
+		if history_id is None:
+			history_id = len(self.__history_ids[n-1])
+			self.__history_ids[n-1][history] = history_id
+			history_events = self.__history_events[n-1].get(history)
+			if history_events is not None:
+				self.__event_histories[n-1][history_events] = history_id
+		lower = self.__entry(ngram[1:]) if n > 1 else -1
+
+		result = len(self.__entries[n-1])
+		self.__entries[n-1][ngram] = result
+		self.__entry_counts[n-1].append(0)
+		self.__entry_histories[n-1].append(history_id)
+		self.__entry_lowers[n-1].append(lower)
+		ngram_events = self.__ngram_events[n-1].get(ngram)
+		if ngram_events is not None:
+			self.__event_entries[n-1][ngram_events] = result
+		return result
+
+	def subtract_counts(self, counts):
+		self.add_counts(counts, -1)
+
+	# Fixes the vocabulary to the words that currently occur in the training
+	# data, so that subtracting counts won't make words out of vocabulary.
+	def fix_vocabulary(self):
+		self.__vocabulary_size = self.__unigram_types
+		self.__in_vocabulary = self.__ngram_counts[0] > 0
+
+	def __current_vocabulary_size(self):
+		if self.__vocabulary_size is not None:
+			return max(self.__vocabulary_size, 1)
+		else:
+			return max(self.__unigram_types, 1)
+
+	# Returns the probability of each event (a word in a history) in the
+	# evaluation text.
+	def __event_probs(self):
+		probs = numpy.full(self.__num_events, 1.0 / self.__current_vocabulary_size())
+		for n in range(self.__order):
+			totals = self.__history_totals[n]
+			types = self.__history_types[n]
+			denominators = totals + types
+			seen = denominators > 0
+			probs[seen] = (self.__ngram_counts[n][seen] + types[seen] * probs[seen]) / denominators[seen]
+		return probs
+
+	# Returns the probability of each event, when n-grams that occur less than
+	# the minimum count are excluded from the model. The probability of an
+	# excluded or unseen n-gram is the lower order probability multiplied by
+	# the backoff weight of the history. The backoff weight is computed so that
+	# the probabilities of all the words following the history sum to one, so
+	# it depends on all the n-grams that follow the history. The probabilities
+	# of the table entries and the backoff weights are computed one order at a
+	# time, starting from unigrams.
+	def __backoff_event_probs(self):
+		uniform_prob = 1.0 / self.__current_vocabulary_size()
+		probs = numpy.full(self.__num_events, uniform_prob)
+		entry_probs = None
+		for n in range(self.__order):
+			counts = numpy.frombuffer(self.__entry_counts[n], dtype='d')
+			histories = numpy.frombuffer(self.__entry_histories[n], dtype='q')
+			num_histories = len(self.__history_ids[n])
+			totals = numpy.bincount(histories, counts, num_histories)
+			types = numpy.bincount(histories, counts > 0, num_histories)
+			if n == 0:
+				lower_probs = numpy.full(len(counts), uniform_prob)
+			else:
+				lowers = numpy.frombuffer(self.__entry_lowers[n], dtype='q')
+				lower_probs = entry_probs[lowers]
+			denominators = totals[histories] + types[histories]
+			with numpy.errstate(invalid='ignore', divide='ignore'):
+				interpolated = (counts + types[histories] * lower_probs) / denominators
+				if n == 0:
+					unigram_weights = types / (totals + types)
+
+			if n == 0:
+				# All the unigrams are included in the model.
+				entry_probs = interpolated
+				backoff_weights = unigram_weights
+			else:
+				kept = counts >= self.__min_counts[n]
+				numerators = 1.0 - numpy.bincount(histories, numpy.where(kept, interpolated, 0), num_histories)
+				denominators = 1.0 - numpy.bincount(histories, numpy.where(kept, lower_probs, 0), num_histories)
+				valid = (numerators > 0) & (denominators > 0)
+				backoff_weights = numpy.ones(num_histories)
+				backoff_weights[valid] = numerators[valid] / denominators[valid]
+				entry_probs = numpy.where(kept, interpolated, backoff_weights[histories] * lower_probs)
+
+			# Events whose history has no successors use the lower order
+			# probability. The probability of an n-gram that is not in the
+			# table is given by the backoff weight (for unigrams, the
+			# interpolation weight of the uniform distribution).
+			event_entries = self.__event_entries[n]
+			event_histories = self.__event_histories[n]
+			seen = event_histories >= 0
+			seen[seen] = types[event_histories[seen]] > 0
+			in_table = seen & (event_entries >= 0)
+			unseen = seen & (event_entries < 0)
+			probs[in_table] = entry_probs[event_entries[in_table]]
+			probs[unseen] = backoff_weights[event_histories[unseen]] * probs[unseen]
+		return probs
+
+	# Returns the natural logarithm of the probability of the evaluation text,
+	# the number of words that were scored (including sentence ends), and the
+	# number of out-of-vocabulary words.
+	def logprob(self):
+		if self.__in_vocabulary is not None:
+			scored = self.__in_vocabulary
+		else:
+			scored = self.__ngram_counts[0] > 0
+		if self.__min_counts is None:
+			probs = self.__event_probs()
+		else:
+			probs = self.__backoff_event_probs()
+		probs = probs[scored]
+		weights = self.__weights[scored]
+		num_words = int(weights.sum())
+		num_oovs = int(self.__weights.sum()) - num_words
+		return float((weights * numpy.log(probs)).sum()), num_words, num_oovs
+
+	def perplexity(self):
+		logprob, num_words, num_oovs = self.logprob()
+		if num_words == 0:
+			return float('inf'), num_oovs
+		return float(numpy.exp(-logprob / num_words)), num_oovs
+
+
+# Returns the words of a sentence, without the sentence start and end tokens,
+# or None if the line is empty.
+def sentence_words(line):
+	words = line.split()
+	if not words:
+		return None
+	if words[0] == '<s>':
+		words = words[1:]
+	if words and (words[-1] == '</s>'):
+		words = words[:-1]
+	return words
@@ -5,6 +5,30 @@
 # everything but the current page, to the child's standard input. The subprocess
 # should score the text based on perplexity or similar measure.
 #
+# With --workers=N, starts N persistent scoring processes, instead of one process
+# per page, so that e.g. a language model needs to be loaded only once. Each
+# page is sent to an idle process as a line that contains the length of the
+# page in bytes, followed by the UTF-8 encoded page content. The process should
+# write the score on one line and flush its output. read_framed_pages() in
+# pages.py implements reading the pages.
+#
+# With --python, the command is a Python function given as "module:function",
+# which takes the text and returns the score. The pages are scored in a pool of
+# --workers processes (by default one per CPU). If the module defines an
+# initialize() function, it is called once in each worker process with the
+# --scorer-arg arguments, e.g. to load a language model. lmscorer.py contains
+# scoring functions that use an ARPA language model, for example:
+#
+#   score-pages.py --python --scorer-arg=model.arpa lmscorer:perplexity input.pages
+#
+# With --builtin and --unit=exclude, the command is "logprob" or "perplexity",
+# and the score is the log probability or perplexity of --devel-text, given by
+# an interpolated Witten-Bell language model that is estimated from everything
+# but the current page. The n-gram counts are collected from the entire data
+# only once, and the counts of each page are subtracted from them, instead of
+# sending the data to a scoring program once for each page. The vocabulary is
+# the words in the entire data.
+#
 # Author: Seppo Enarvi
 # http://users.marjaniemi.com/seppo/
 
@@ -12,7 +36,12 @@ import argparse
 import sys
 import io
 import subprocess
+import selectors
+import importlib
+import multiprocessing
 from pages import *
+from perplexity import WittenBellEvaluator
+from ngramcounts import NGramCounts
 from filetypes import TextFileType
 
 
@@ -32,6 +61,167 @@ def write_error(return_code, score_str, stdout, stderr):
 	sys.stderr.write(score_str)
 
 
+def write_text(pages, uri, include_match, output_file):
+	if include_match:
+		if isinstance(pages, PageStore):
+			pages.write_content(uri, output_file)
+		else:
+			output_file.write(pages[uri])
+	else:
+		for uri2 in pages:
+			if uri2 != uri:
+				if isinstance(pages, PageStore):
+					pages.write_content(uri2, output_file)
+				else:
+					output_file.write(pages[uri2])
+
+def parse_score(uri, return_code, score_str, stdout='', stderr=''):
+	if (score_str == '') or (return_code != 0) or (stdout != '') or (stderr != ''):
+		sys.stderr.write("Scoring script failed on page %s.\n" % uri)
+		write_error(return_code, score_str, stdout, stderr)
+		sys.exit(4)
+	try:
+		return float(score_str)
+	except ValueError:
+		sys.stderr.write("Scoring script returned an invalid score for page %s.\n" % uri)
+		write_error(return_code, score_str, stdout, stderr)
+		sys.exit(3)
+
+# Scores the pages using one process per page.
+def score_each(uris, pages, include_match, scores_file, progress):
+	for index, uri in enumerate(uris):
+		progress(index)
+		process = subprocess.Popen([args.command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE);
+		output_file = io.TextIOWrapper(process.stdin, 'utf-8')
+		write_text(pages, uri, include_match, output_file)
+		output_file.close()
+		score_str = process.stdout.readline().decode('utf-8').rstrip()
+		stdout = process.stdout.read().decode('utf-8').rstrip()
+		stderr = process.stderr.read().decode('utf-8').rstrip()
+		process.wait()
+		score = parse_score(uri, process.returncode, score_str, stdout, stderr)
+		scores_file.write("###### %s\n%f\n" % (uri, score))
+		scores_file.flush()
+
+# Scores the pages using persistent processes. Pages are sent to idle processes
+# as they finish. The scores are written in the same order as the pages.
+def score_with_workers(uris, pages, include_match, scores_file, progress, num_workers):
+	selector = selectors.DefaultSelector()
+	idle_workers = []
+	for i in range(num_workers):
+		process = subprocess.Popen([args.command], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+		idle_workers.append(process)
+
+	scores = dict()
+	next_to_send = 0
+	next_to_write = 0
+	while next_to_write < len(uris):
+		while idle_workers and (next_to_send < len(uris)):
+			progress(next_to_send)
+			process = idle_workers.pop()
+			uri = uris[next_to_send]
+			text = io.TextIOWrapper(io.BytesIO(), 'utf-8')
+			write_text(pages, uri, include_match, text)
+			text.flush()
+			try:
+				write_framed_page(process.stdin, text.buffer.getvalue())
+			except BrokenPipeError:
+				parse_score(uri, process.wait(), '')
+			selector.register(process.stdout, selectors.EVENT_READ, (process, next_to_send))
+			next_to_send += 1
+
+		for key, _ in selector.select():
+			process, index = key.data
+			selector.unregister(key.fileobj)
+			score_str = process.stdout.readline().decode('utf-8').rstrip()
+			if score_str == '':
+				return_code = process.wait()
+			else:
+				return_code = 0
+			scores[index] = parse_score(uris[index], return_code, score_str)
+			idle_workers.append(process)
+
+		while next_to_write in scores:
+			uri = uris[next_to_write]
+			scores_file.write("###### %s\n%f\n" % (uri, scores.pop(next_to_write)))
+			next_to_write += 1
+		scores_file.flush()
+
+	for process in idle_workers:
+		process.stdin.close()
+		process.wait()
+
+
+# Imports a Python scoring function given as "module:function", and calls
+# initialize() from the module, if it exists. Called once in each worker
+# process.
+def load_scorer(spec, scorer_args):
+	global scorer
+	module_name, _, function_name = spec.partition(':')
+	module = importlib.import_module(module_name)
+	if hasattr(module, 'initialize'):
+		module.initialize(*scorer_args)
+	scorer = getattr(module, function_name)
+
+# Initializes a worker process of score_with_python(). Pages that are read from
+# disk are reopened, so that the worker does not share file offsets with the
+# other processes.
+def init_python_worker(spec, scorer_args, pages, include_match):
+	global worker_pages, worker_include_match
+	if isinstance(pages, PageStore):
+		pages.reopen()
+	worker_pages = pages
+	worker_include_match = include_match
+	load_scorer(spec, scorer_args)
+
+def score_in_process(uri):
+	text = io.StringIO()
+	write_text(worker_pages, uri, worker_include_match, text)
+	return float(scorer(text.getvalue()))
+
+# Scores the pages using a Python function in a pool of worker processes. The
+# processes are forked, so they can access the pages without copying.
+def score_with_python(uris, pages, include_match, scores_file, progress, num_workers):
+	context = multiprocessing.get_context('fork')
+	init_args = (args.command, args.scorer_args, pages, include_match)
+	with context.Pool(num_workers, init_python_worker, init_args) as pool:
+		for index, score in enumerate(pool.imap(score_in_process, uris, 16)):
+			progress(index)
+			scores_file.write("###### %s\n%f\n" % (uris[index], score))
+			scores_file.flush()
+
+
+def page_counts(pages, uri, order):
+	text = io.StringIO()
+	write_text(pages, uri, True, text)
+	result = NGramCounts()
+	result.from_text(text.getvalue(), order, True)
+	return result
+
+# Scores the pages using a built-in Witten-Bell model, by subtracting the counts
+# of each page from the counts of the entire data.
+def score_builtin_exclude(uris, pages, scores_file, progress):
+	devel_text = args.devel_text.read()
+	args.devel_text.close()
+	evaluator = WittenBellEvaluator(devel_text, args.order)
+	sys.stderr.write("Collecting n-gram counts.\n")
+	for uri in pages:
+		evaluator.add_counts(page_counts(pages, uri, args.order))
+	evaluator.fix_vocabulary()
+
+	for index, uri in enumerate(uris):
+		progress(index)
+		counts = page_counts(pages, uri, args.order)
+		evaluator.subtract_counts(counts)
+		if args.command == "logprob":
+			score = evaluator.logprob()[0]
+		else:
+			score = evaluator.perplexity()[0]
+		evaluator.add_counts(counts)
+		scores_file.write("###### %s\n%f\n" % (uri, score))
+		scores_file.flush()
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('command', type=str, help='a command that scores text')
 parser.add_argument('input', type=TextFileType('r'), nargs='+', help='input text page files')
@@ -39,6 +229,12 @@ parser.add_argument('--in-memory', action='store_true', default=False, help='loa
 parser.add_argument('--unit', type=str, default='each', help='send one page at a time ("each"), everything but one page at a time ("exclude"), or all at once ("all")')
 parser.add_argument('--scores', type=str, default='-', help='output scores file')
 parser.add_argument('--merge-fragments', action='store_true', default=False, help='merge pages whose URI only differs after fragment identifier')
+parser.add_argument('--workers', type=int, default=None, help='start this many persistent scoring processes that read pages prefixed by their length in bytes')
+parser.add_argument('--python', action='store_true', default=False, help='the command is a Python function "module:function" that takes the text and returns the score')
+parser.add_argument('--scorer-arg', type=str, dest='scorer_args', action='append', default=[], help='an argument to the initialize() function of the Python scoring module (may be given multiple times)')
+parser.add_argument('--builtin', action='store_true', default=False, help='the command is a built-in scorer, "logprob" or "perplexity" of --devel-text (requires --unit=exclude)')
+parser.add_argument('--devel-text', type=TextFileType('r'), default=None, help='development text for built-in scorers')
+parser.add_argument('--order', type=int, default=3, help='language model order for built-in scorers')
 parser.add_argument('-B', '--batch', type=int, dest='num_batches', default=1, help='number of batches to split the job into')
 parser.add_argument('-I', '--bindex', type=int, dest='batch_index', default=1, help='index of this batch, starting from 1')
 args = parser.parse_args()
@@ -61,12 +257,38 @@ else:
 				existing_uris.add(line[7:].strip())
 		scores_file.close()
 		scores_file = TextFileType('a')(args.scores)
-		scores_file = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
 	except argparse.ArgumentTypeError:
 		scores_file = TextFileType('w')(args.scores)
 
+if (args.workers is not None) and (args.workers < 1):
+	sys.stderr.write("At least one worker is required.\n")
+	sys.exit(2)
+if args.builtin:
+	if args.unit != "exclude":
+		sys.stderr.write("Built-in scorers require --unit=exclude.\n")
+		sys.exit(2)
+	if not args.command in ("logprob", "perplexity"):
+		sys.stderr.write("Unknown built-in scorer: " + args.command + "\n")
+		sys.exit(2)
+	if args.devel_text is None:
+		sys.stderr.write("Built-in scorers require --devel-text.\n")
+		sys.exit(2)
+if args.python:
+	if not ':' in args.command:
+		sys.stderr.write("Python scoring function should be given as module:function.\n")
+		sys.exit(2)
+	if args.workers is None:
+		args.workers = multiprocessing.cpu_count()
+
 # Send pages according to --unit.
-if args.unit == "all":
+if (args.unit == "all") and args.python:
+	load_scorer(args.command, args.scorer_args)
+	text = io.StringIO()
+	for input_file in args.input:
+		write_all_content(input_file, text)
+	scores_file.write(str(float(scorer(text.getvalue()))))
+
+elif args.unit == "all":
 	process = subprocess.Popen([args.command], stdin=subprocess.PIPE, stdout=subprocess.PIPE);
 	output_file = io.TextIOWrapper(process.stdin, 'utf-8')
 	for input_file in args.input:
@@ -84,57 +306,41 @@ else:
 		sys.stderr.write("Unknown unit: " + args.unit + "\n")
 		sys.exit(2)
 
-	all_uris = set()
-	pages = dict()
-	for input_file in args.input:
-		for page in read_pages(input_file, not args.merge_fragments):
-			uri = page.uri()
-			all_uris.add(uri)
-			if uri in pages:
-				pages[uri] += page.content()
-			else:
-				pages[uri] = page.content()
+	if args.in_memory:
+		pages = dict()
+		for input_file in args.input:
+			for page in read_pages(input_file, not args.merge_fragments):
+				uri = page.uri()
+				if uri in pages:
+					pages[uri] += page.content()
+				else:
+					pages[uri] = page.content()
+			input_file.close()
+	else:
+		# Only the page index is read into memory.
+		for input_file in args.input:
+			input_file.close()
+		pages = PageStore([x.name for x in args.input], not args.merge_fragments)
+	all_uris = set(pages)
 
 	batch_uris = sorted(all_uris)[args.batch_index-1::args.num_batches]
+	batch_uris = [uri for uri in batch_uris if not uri in existing_uris]
 	previous_progress = -1
-	for index, uri in enumerate(batch_uris):
-		if uri in existing_uris:
-			continue
-		progress = int(index * 100 / len(batch_uris))
-		if progress > previous_progress:
-			sys.stderr.write("Batch %i/%i: %i %% done.\n" % (args.batch_index, args.num_batches, progress))
-			previous_progress = progress
+	def progress(index):
+		global previous_progress
+		percent = int(index * 100 / len(batch_uris))
+		if percent > previous_progress:
+			sys.stderr.write("Batch %i/%i: %i %% done.\n" % (args.batch_index, args.num_batches, percent))
+			previous_progress = percent
 		sys.stderr.flush()
-		process = subprocess.Popen([args.command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE);
-		output_file = io.TextIOWrapper(process.stdin, 'utf-8')
-		if args.in_memory:
-			if include_match:
-				output_file.write(pages[uri])
-			else:
-				for uri2 in all_uris:
-					if uri2 != uri:
-						output_file.write(pages[uri2])
-		else:
-			for input_file in args.input:
-				write_matching_content(input_file, output_file, uri, args.merge_fragments, include_match)
-		output_file.close()
-		process.stdin.close()
-		score_str = process.stdout.readline().decode('utf-8').rstrip()
-		stdout = process.stdout.read().decode('utf-8').rstrip()
-		stderr = process.stderr.read().decode('utf-8').rstrip()
-		process.wait()
-		return_code = process.returncode
-		if (score_str == '') or (return_code != 0) or (stdout != '') or (stderr != ''):
-			sys.stderr.write("Scoring script failed on page %s.\n" % uri)
-			write_error(return_code, score_str, stdout, stderr)
-			sys.exit(4)
-		try:
-			score = float(score_str)
-		except ValueError:
-			sys.stderr.write("Scoring script returned an invalid score for page %s.\n" % uri)
-			write_error(return_code, score_str, stdout, stderr)
-			sys.exit(3)
-		scores_file.write("###### %s\n%f\n" % (uri, score))
-		scores_file.flush()
+
+	if args.builtin:
+		score_builtin_exclude(batch_uris, pages, scores_file, progress)
+	elif args.python:
+		score_with_python(batch_uris, pages, include_match, scores_file, progress, args.workers)
+	elif args.workers is None:
+		score_each(batch_uris, pages, include_match, scores_file, progress)
+	else:
+		score_with_workers(batch_uris, pages, include_match, scores_file, progress, args.workers)
 
 	sys.stderr.write("Batch %i/%i finished.\n" % (args.batch_index, args.num_batches))
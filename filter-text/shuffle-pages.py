@@ -15,38 +15,55 @@ from filetypes import TextFileType
 parser = argparse.ArgumentParser()
 parser.add_argument('input', type=TextFileType('r'), nargs='+', help='input text page files')
 parser.add_argument('--output', type=TextFileType('w'), default='-', help='output file for reordered text pages')
+parser.add_argument('--in-memory', action='store_true', default=False, help='load the entire data set into memory')
 args = parser.parse_args()
 
-pages = dict()
-for input_file in args.input:
-	sys.stderr.write("Reading input file %s.\n" % input_file.name)
+if args.in_memory:
+	# The content is stored UTF-8 encoded, so that it can be written to the
+	# binary output buffer like the content of pages that are read from disk.
+	pages = dict()
+	for input_file in args.input:
+		for page in read_pages(input_file):
+			content = page.content().encode('utf-8')
+			uri = page.uri()
+			if uri in pages:
+				pages[uri] += content
+			else:
+				pages[uri] = content
+		input_file.close()
+else:
+	for input_file in args.input:
+		input_file.close()
+	sys.stderr.write("Reading page indices.\n")
 	sys.stderr.flush()
-	for page in read_page_pointers(input_file):
-		uri = page.uri()
-		if uri in pages:
-			pages[uri].add_pages(page.pointers())
-		else:
-			pages[uri] = page
+	pages = PageStore([x.name for x in args.input])
 
 num_pages = len(pages)
 sys.stderr.write("%i pages in the input files.\n" % num_pages)
 sys.stderr.flush()
 
-ordered_pages = list(pages.values())
-random.shuffle(ordered_pages)
+ordered_uris = list(pages)
+random.shuffle(ordered_uris)
 sys.stderr.write("Random permutation generated.\n")
 sys.stderr.flush()
 
+# Page content is written from the memory-mapped input files directly to the
+# binary output buffer.
+output = args.output.buffer
 previous_progress = -1
 num_written_pages = 0
-for page in ordered_pages:
-	args.output.write(page.header())
-	args.output.write(page.content())
-	args.output.flush()
+for uri in ordered_uris:
+	output.write(b'###### ' + uri.encode('utf-8') + b'\n')
+	if args.in_memory:
+		output.write(pages[uri])
+	else:
+		pages.write_content(uri, output)
 
 	num_written_pages += 1
 	progress = int(num_written_pages * 100 / num_pages)
 	if progress > previous_progress:
+		output.flush()
 		sys.stderr.write("%i %% done.\n" % progress)
 		sys.stderr.flush()
 		previous_progress = progress
+output.flush()
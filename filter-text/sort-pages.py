@@ -11,10 +11,23 @@
 #
 # If a development text is given with the --devel-text option, estimates a
 # language model from the output text every N pages, and writes perplexity and
-# OOV rate of the development text to a CSV file (this requires SRILM tools).
-# If also a word segmentation file is given with the --word-seg option, uses
-# subword perplexity (this requires the variKN tools). N is selected so that
-# perplexity will be calculated at most 500 times.
+# OOV rate of the development text to a CSV file. If also a word segmentation
+# file is given with the --word-seg option, uses subword perplexity. If the text
+# is already segmented into subwords, give --text-is-subwords instead, which
+# takes precedence over --word-seg. The vocabulary given with --vocab is only
+# used for word-based perplexity. N is selected so that perplexity will be
+# calculated at most 500 times.
+#
+# Word perplexity is computed using a bigram model, and subword perplexity using
+# a model of order --order. Subword perplexity uses <s> <w> as the initial
+# history of each sentence, so the first word boundary is not scored, as in
+# variKN perplexity -t 2.
+#
+# The language model is an interpolated Witten-Bell model. It is not trained
+# from scratch every time. Instead, the n-gram counts of each page are added to
+# the counts of the development text n-grams and their histories, as the page
+# is output. Computing the perplexity then takes time that depends only on the
+# size of the development text.
 #
 # Author: Seppo Enarvi
 # http://users.marjaniemi.com/seppo/
@@ -23,10 +36,9 @@ import argparse
 import sys
 import io
 import operator
-import subprocess
-import tempfile
 from pages import *
 from perplexity import *
+from ngramcounts import NGramCounts
 from filetypes import TextFileType
 
 parser = argparse.ArgumentParser()
@@ -39,26 +51,31 @@ parser.add_argument('--descending', action='store_true', default=False, help='so
 parser.add_argument('--include', type=int, default=None, help='output only this many pages')
 parser.add_argument('--write-scores', action='store_true', default=False, help='also output scores')
 parser.add_argument('--devel-text', type=TextFileType('r'), default=None, help='periodically estimate a language model and compute its perplexity on this text')
-parser.add_argument('--word-seg', type=TextFileType('r'), default=None, help='use this segmentation to segment words into subwords before computing perplexities with variKN')
-parser.add_argument('--text-is-subwords', action='store_true', default=False, help='computes perplexities using variKN, assuming the text is already subwords')
-parser.add_argument('--order', type=int, default=3, help='language model order for perplexity computations')
+parser.add_argument('--word-seg', type=TextFileType('r'), default=None, help='use this segmentation to segment words into subwords before computing perplexities')
+parser.add_argument('--text-is-subwords', action='store_true', default=False, help='assume the text is already subwords')
+parser.add_argument('--order', type=int, default=3, help='language model order for subword perplexity computations (word perplexity is computed using a bigram model)')
 parser.add_argument('--vocab', type=str, default=None, help='vocabulary for word-based perplexity computations')
 parser.add_argument('--statistics', type=TextFileType('w'), dest='statistics', default=None, help='where to write the CSV statistics to')
 args = parser.parse_args()
 
-uris = set()
-pages = dict()
-for input_file in args.input:
-	for page in read_pages(input_file, not args.merge_fragments):
-		uri = page.uri()
-		uris.add(uri)
-		if args.in_memory:
+if args.in_memory:
+	uris = set()
+	pages = dict()
+	for input_file in args.input:
+		for page in read_pages(input_file, not args.merge_fragments):
+			uri = page.uri()
+			uris.add(uri)
 			if uri in pages:
 				pages[uri] += page.content()
 			else:
 				pages[uri] = page.content()
-	if args.in_memory:
 		input_file.close()
+else:
+	# Only the page index is read into memory.
+	for input_file in args.input:
+		input_file.close()
+	pages = PageStore([x.name for x in args.input], not args.merge_fragments)
+	uris = pages
 
 sys.stderr.write("%i pages in the input files.\n" % len(uris))
 if args.include is None:
@@ -68,14 +85,34 @@ scores = read_scores(args.scores)
 sys.stderr.write("Read %i scores.\n" % len(scores))
 sorted_scores = sorted(scores.items(), key=operator.itemgetter(1), reverse=args.descending)
 
-if args.word_seg is not None:
+if (args.word_seg is not None) and (not args.text_is_subwords):
 	wsegs = read_word_segmentations(args.word_seg)
 	sys.stderr.write("Read %i word segmentations.\n" % len(wsegs))
 else:
 	wsegs = None
 
 if (args.devel_text is not None) and (args.statistics is not None):
-	train_text = tempfile.NamedTemporaryFile(mode='w+', encoding="utf-8")
+	devel_text = args.devel_text.read()
+	args.devel_text.close()
+	subwords = (wsegs is not None) or args.text_is_subwords
+	if wsegs is not None:
+		devel_text = '\n'.join(' '.join(segment_line(line, wsegs)) for line in devel_text.splitlines())
+	if (args.vocab is not None) and (not subwords):
+		with open(args.vocab, encoding='utf-8') as vocab_file:
+			vocabulary = vocab_file.read().split()
+	else:
+		vocabulary = None
+	if subwords:
+		order = args.order
+		initial_history_length = 2
+	else:
+		order = 2
+		initial_history_length = 1
+	# Same as SRILM ngram-count -unk -vocab, when a vocabulary is given.
+	evaluator = WittenBellEvaluator(devel_text, order, vocabulary,
+	                                open_vocabulary=vocabulary is not None,
+	                                min_counts=srilm_min_counts(order),
+	                                initial_history_length=initial_history_length)
 	
 	args.statistics.write("pages, threshold score, perplexity, OOVs\n")
 	
@@ -85,33 +122,21 @@ if (args.devel_text is not None) and (args.statistics is not None):
 		if not uri in uris:
 			continue
 		if args.in_memory:
-			train_text.write(pages[uri])
+			text = pages[uri]
 		else:
-			for input_file in args.input:
-				input_file.seek(0)
-				write_matching_content(input_file, train_text, uri, args.merge_fragments)
+			text = pages.content(uri)
+		if wsegs is not None:
+			text = '\n'.join(' '.join(segment_line(line, wsegs)) for line in text.splitlines() if line.strip())
+		counts = NGramCounts()
+		counts.from_text(text, order, True)
+		evaluator.add_counts(counts)
 		page_count += 1
 		if page_count >= len(uris) / 500 * stats_count:
 			stats_count += 1
-			try:
-				train_text.flush()
-				if args.text_is_subwords:
-					train_text.seek(0)
-					perplexity, num_oovs = subword_perplexity(train_text, args.devel_text, None, args.order)
-					train_text.seek(0, 2)
-				elif wsegs is not None:
-					train_text.seek(0)
-					perplexity, num_oovs = subword_perplexity(train_text, args.devel_text, wsegs, args.order)
-					train_text.seek(0, 2)
-				else:
-					perplexity, num_oovs = word_perplexity(train_text.name, args.devel_text, args.vocab)
-				args.statistics.write("%i, %f, %f, %i\n" % (page_count, score, perplexity, num_oovs))
-				args.statistics.flush()
-				sys.stderr.write("page_count=%i, score=%f, perplexity=%f, num_oovs=%i\n" % (page_count, score, perplexity, num_oovs))
-			except subprocess.CalledProcessError as e:
-				# Currently perplexity computation may fail if there are no
-				# 3-grams yet in the training data. Just continue.
-				sys.stderr.write("Unable to compute perplexity yet. Continuing.\n")
+			perplexity, num_oovs = evaluator.perplexity()
+			args.statistics.write("%i, %f, %f, %i\n" % (page_count, score, perplexity, num_oovs))
+			args.statistics.flush()
+			sys.stderr.write("page_count=%i, score=%f, perplexity=%f, num_oovs=%i\n" % (page_count, score, perplexity, num_oovs))
 		if page_count >= args.include:
 			break
 
@@ -127,9 +152,7 @@ elif args.output is not None:
 			try:
 				if args.write_scores:
 					sys.stdout.write("###### score=" + str(score) + "\n")
-				for input_file in args.input:
-					input_file.seek(0)
-					write_matching_content(input_file, args.output, uri, args.merge_fragments)
+				pages.write_content(uri, args.output)
 			except IOError:
 				# Silently ignore write errors, since we'll get a SIGPIPE if the
 				# output is piped to head.
@@ -15,6 +15,15 @@ class NGramCounts:
 	def __getitem__(self, ngram):
 		return self.__counts[ngram]
 	
+	def __len__(self):
+		return len(self.__counts)
+	
+	def get(self, ngram, default=0):
+		return self.__counts.get(ngram, default)
+	
+	def items(self):
+		return self.__counts.items()
+	
 	def read(self, input_file, max_order=None, min_count=None):
 		lines_read = 0
 		for line in input_file:
@@ -30,11 +39,24 @@ class NGramCounts:
 				continue
 			self.__counts[ngram] = count
 	
-	def from_text(self, text, max_order):
+	# Collects the n-grams of a text. If sentence_boundaries is True, each
+	# non-empty line is a sentence that starts with <s> and ends with </s>, and
+	# n-grams don't cross sentence boundaries (as in SRILM ngram-count). The
+	# sentence start and end tokens are added, unless the line already starts
+	# and ends with them.
+	def from_text(self, text, max_order, sentence_boundaries=False):
 		lines = text.splitlines()
 		history = []
 		for line in lines:
 			words = line.split()
+			if sentence_boundaries:
+				if not words:
+					continue
+				if words[0] != '<s>':
+					words.insert(0, '<s>')
+				if (len(words) == 1) or (words[-1] != '</s>'):
+					words.append('</s>')
+				history = []
 			for word in words:
 				history.append(word)
 				if len(history) > max_order:
@@ -53,6 +75,18 @@ class NGramCounts:
 		else:
 			self.__counts[ngram] = 1
 
+	# Adds count (which may be negative) to the count of an n-gram. N-grams
+	# whose count drops to zero are removed. Returns the new count.
+	def add(self, ngram, count):
+		count += self.__counts.get(ngram, 0)
+		if count > 0:
+			self.__counts[ngram] = count
+		elif count == 0:
+			self.__counts.pop(ngram, None)
+		else:
+			raise ValueError("NGramCounts.add: Negative count for n-gram " + ' '.join(ngram) + ".")
+		return count
+
 	def level(self, n):
 		for ngram, count in self.__counts.items():
 			if len(ngram) == n:
@@ -50,16 +50,96 @@ format statistical language model files.
 #__author__ = "David Huggins-Daines <dhuggins@cs.cmu.edu>"
 #__version__ = "$Revision: 19 $"
   
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
 import numpy
 import gzip
+import mmap
+from array import array
+import struct
 import re
 import os
+import multiprocessing
+import threading
+import queue
   
 LOG10TOLOG = numpy.log(10)
 LOGTOLOG10 = 1./LOG10TOLOG
 LOG0STR = '-99'
 
+# Binary model file: magic, order, and the size of the vocabulary in bytes,
+# followed by the number of n-grams of each order, the number of added
+# histories of each order, the vocabulary as newline separated UTF-8 words, and
+# the arrays of each order, aligned to 8 bytes. Files written before histories
+# were added (ARPALMB1) don't have the number and the IDs of added histories.
+BINARY_MAGIC = b'ARPALMB2'
+BINARY_MAGIC_V1 = b'ARPALMB1'
+BINARY_HEADER = '<8sQQ'
+
+# Input file and output arrays of ArpaLM.read_parallel(), shared with the
+# worker processes.
+_parallel_read = None
+
+def _convert_inprob(x):
+	if x == LOG0STR:
+		return float("-inf")
+	else:
+		return float(x) * LOG10TOLOG
+
+def _read_unigram_lines(byte_range):
+	"""
+	Parse a range of the 1-gram section of the file that is being read
+	by ArpaLM.read_parallel().  Returns the words, and an array of
+	probabilities and backoff weights.
+	"""
+	start, end = byte_range
+	text = _parallel_read['mapping'][start:end].decode('utf-8')
+	words = []
+	vals = array('d')
+	for line in text.splitlines():
+		fields = line.split()
+		if len(fields) == 3:
+			b = _convert_inprob(fields[2])
+		elif len(fields) == 2:
+			b = 0.0
+		else:
+			raise RuntimeError("Invalid 1-gram line: " + line)
+		words.append(fields[1])
+		vals.append(_convert_inprob(fields[0]))
+		vals.append(b)
+	return words, numpy.frombuffer(vals, 'd').reshape(-1, 2)
+
+def _read_ngram_lines(task):
+	"""
+	Parse a range of the N-gram section of order n of the file that is
+	being read by ArpaLM.read_parallel(), and write the word IDs and the
+	probabilities and backoff weights to the shared arrays, starting
+	from the given row.  Returns the number of N-grams that were read.
+	"""
+	n, start, end, row = task
+	text = _parallel_read['mapping'][start:end].decode('utf-8')
+	wordmap = _parallel_read['wordmap']
+	ids = array('q')
+	vals = array('d')
+	for line in text.splitlines():
+		fields = line.split()
+		if len(fields) == n + 2:
+			b = _convert_inprob(fields[-1])
+		elif len(fields) == n + 1:
+			b = 0.0
+		else:
+			raise RuntimeError("Found %d-gram in %d-gram section" % (len(fields)-1, n))
+		try:
+			ids.extend([wordmap[w] for w in fields[1:n+1]])
+		except KeyError as e:
+			raise RuntimeError("Word %s not found in 1-grams" % e.args[0])
+		vals.append(_convert_inprob(fields[0]))
+		vals.append(b)
+	count = len(vals) // 2
+	_parallel_read['ids'][n][row:row+count] = numpy.frombuffer(ids, 'i8').reshape(-1, n)
+	_parallel_read['vals'][n][row:row+count] = numpy.frombuffer(vals, 'd').reshape(-1, 2)
+	return count
+
 class ArpaLM(object):
 	"Class for reading ARPA-format language models"
 	class NGram(object):
@@ -84,15 +164,150 @@ class ArpaLM(object):
 			self.word = word
 
 
-	def __init__(self, fh=None, lw=1.0, wip=1.0):
+	class QueryCache(object):
+		"""
+		Bounded cache of query results that discards the least
+		recently used entries when it is full.
+		@ivar hits: Number of queries that were found in the cache
+		@type hits: int
+		@ivar misses: Number of queries that were not found
+		@type misses: int
+		@ivar evictions: Number of entries that have been discarded
+		@type evictions: int
+		"""
+		def __init__(self, max_size):
+			self.max_size = max_size
+			self.entries = OrderedDict()
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
+
+		def get(self, key):
+			try:
+				value = self.entries[key]
+			except KeyError:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value
+
+		def put(self, key, value):
+			self.entries[key] = value
+			if len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+		def clear(self):
+			self.entries.clear()
+
+		def statistics(self):
+			queries = self.hits + self.misses
+			return {'size': len(self.entries),
+			        'hits': self.hits,
+			        'misses': self.misses,
+			        'evictions': self.evictions,
+			        'hit_rate': self.hits / queries if queries > 0 else 0.0}
+
+
+	class NGramIndex(Mapping):
+		"""
+		Mapping from N-Grams of one order to their IDs in the sorted
+		arrays.
+		"""
+		def __init__(self, lm, m):
+			self.lm = lm
+			self.m = m
+
+		def __getitem__(self, ng):
+			ngid = self.find(ng)
+			if ngid < 0:
+				raise KeyError(ng)
+			return ngid
+
+		def __contains__(self, ng):
+			return self.find(ng) >= 0
+
+		def find(self, ng):
+			if (not isinstance(ng, tuple)) or (len(ng) != self.m + 1):
+				return -1
+			ngid = self.lm._find_ngram(ng)
+			if (ngid >= 0) and self.lm._is_added(self.m, ngid):
+				return -1
+			return ngid
+
+		def __iter__(self):
+			tuples = self.lm._ngram_tuples(self.m)
+			real = self.lm._real_mask(self.m)
+			return (ng for ng, is_real in zip(tuples, real) if is_real)
+
+		def __len__(self):
+			return self.lm.ng_counts[self.m + 1]
+
+
+	class SuccessorIndex(Mapping):
+		"""
+		Mapping from M-Grams to lists of their successor words.
+		"""
+		def __init__(self, lm):
+			self.lm = lm
+
+		def __getitem__(self, words):
+			ngids = self.lm._successor_ids(words)
+			if len(ngids) == 0:
+				raise KeyError(words)
+			if isinstance(words, str):
+				words = (words,)
+			vocab_size = len(self.lm.widmap)
+			wids = self.lm.ngkeys[len(words)][ngids] % vocab_size
+			return [self.lm.widmap[wid] for wid in wids]
+
+		def __contains__(self, words):
+			return len(self.lm._successor_ids(words)) > 0
+
+		def __iter__(self):
+			vocab_size = len(self.lm.widmap)
+			for m in range(1, self.lm.n):
+				histories = self.lm._ngram_tuples(m - 1)
+				keys = self.lm.ngkeys[m][self.lm._real_mask(m)]
+				for ctxid in numpy.unique(keys // vocab_size):
+					yield histories[ctxid]
+
+		def __len__(self):
+			return sum(1 for x in self)
+
+
+	def __init__(self, fh=None, lw=1.0, wip=1.0, cache_size=None, processes=None):
 		"""
 		Initialize an ArpaLM object.
 		@param fh: An ARPA format file to (optionally) load
 					 language model from.  This file can be
-					 gzip-compressed if you like.
+					 gzip-compressed if you like.  If a path is
+					 given, the file can also be in the binary
+					 format written by save_binary().
 		@type path: string
+		@param cache_size: Maximum number of query results to cache
+						   (see set_cache_size()).
+		@type cache_size: int
+		@param processes: If a path to an uncompressed ARPA file is
+						  given, read it using this many processes
+						  (see read_parallel()).
+		@type processes: int
 		"""
-		if fh != None:
+		self.set_cache_size(cache_size)
+		if isinstance(fh, str):
+			if self.is_binary(fh):
+				self.read_binary(fh)
+			elif (processes is not None) and (processes > 1) and (not fh.endswith('.gz')):
+				self.read_parallel(fh, processes)
+			else:
+				if fh.endswith('.gz'):
+					f = gzip.open(fh, 'rt', encoding='utf-8')
+				else:
+					f = open(fh, 'r', encoding='utf-8')
+				with f:
+					self.read(f)
+		elif fh != None:
 			self.read(fh)
 		self.lw = lw
 		self.wip = wip
@@ -108,6 +323,10 @@ class ArpaLM(object):
 	def read(self, fh):
 		"""
 		Load an ARPA format language model from a file in its entirety.
+		The number of N-grams of each order has to match the counts
+		in the \\data\\ header, or a RuntimeError is raised.  If
+		the history of an N-gram is not in the model, it is added as
+		described in __add_histories().
 		@param fh: An ARPA format file to (optionally) load
 					 language model from.  This file can be
 					 gzip-compressed if you like.
@@ -129,17 +348,15 @@ class ArpaLM(object):
 			if m != None:
 				n, c = list(map(int, m.groups()))
 				self.ng_counts[n] = c
-		# Word and N-Gram to ID mapping
-		self.ngmap = []
-		# Create probability/backoff arrays:
+		# Probability/backoff arrays:
 		# ngrams: n matrices of [number of n-grams] times 2 elements
-		# ngmap: n dicts
+		# ngkeys: n arrays of [number of n-grams] sorted keys (None for
+		# unigrams), as described in save_binary()
+		# ngadded: n sorted arrays of the IDs of the histories that were
+		# added by __add_histories()
 		self.n = max(self.ng_counts.keys())
-		self.ngrams = []
-		for n in range(1,self.n+1):
-			vals = numpy.zeros((self.ng_counts[n],2),'d')
-			self.ngrams.append(vals)
-			self.ngmap.append({})
+		self.ngkeys = [None]
+		self.ngadded = [numpy.zeros(0, 'i8')]
 		# Read unigrams and create word id list
 		spam = fh.readline().rstrip()
 		if spam != "\\1-grams:":
@@ -147,7 +364,10 @@ class ArpaLM(object):
 		print("Reading %i 1-grams." % self.ng_counts[1])
 		# ID to word mapping
 		self.widmap = []
+		# Word to ID mapping
+		wordmap = {}
 		wordid = 0
+		vals = array('d')
 		while True:
 			spam = fh.readline().rstrip()
 			if spam == "":
@@ -159,16 +379,21 @@ class ArpaLM(object):
 				p,w = spam.split()
 				b = 0
 			p = self.__convert_inprob(p)
-			self.ngmap[0][w] = wordid
+			wordmap[w] = wordid
 			self.widmap.append(w)
-			self.ngrams[0][wordid,:] = p, b
+			vals.append(p)
+			vals.append(b)
 			wordid = wordid + 1
+		self.__check_count(1, wordid)
+		self.ngrams = [numpy.frombuffer(vals, 'd').reshape(-1, 2)]
 
-		# Read N-grams
+		# Read N-grams. The word IDs and the probabilities and backoff
+		# weights of each order are collected in flat arrays, and
+		# sorted when all the N-grams of the order have been read.
 		r = re.compile(r"\\(\d+)-grams:")
-		ngramid = 0
-		# Successor list map
-		self.succmap = {}
+		n = 1
+		ids = array('q')
+		vals = array('d')
 		while True:
 			spam = fh.readline().rstrip()
 			if spam == "":
@@ -181,28 +406,470 @@ class ArpaLM(object):
 					break
 				m = r.match(spam)
 			if m != None:
+				if n > 1:
+					self.__check_count(n, len(vals) // 2)
+					self.__index_ngrams(n, ids, vals)
 				n = int(m.group(1))
-				ngramid = 0
+				if n not in self.ng_counts:
+					raise RuntimeError("%d-grams not declared in the \\data\\ header" % n)
+				ids = array('q')
+				vals = array('d')
 				print("Reading %i %i-grams." % (self.ng_counts[n], n))
 			else:
 				spam = spam.split()
 				p = self.__convert_inprob(spam[0])
 				if len(spam) == n + 2:
-					ng = tuple(spam[1:-1])
 					b = self.__convert_inprob(spam[-1])
 				elif len(spam) == n + 1:
-					ng = tuple(spam[1:])
 					b = 0.0
 				else:
 					raise RuntimeError("Found %d-gram in %d-gram section" % (len(spam)-1, n))
-				# N-Gram info
-				self.ngrams[n-1][ngramid,:] = p, b
-				self.ngmap[n-1][ng] = ngramid
+				try:
+					ids.extend([wordmap[w] for w in spam[1:n+1]])
+				except KeyError as e:
+					raise RuntimeError("Word %s not found in 1-grams" % e.args[0])
+				vals.append(p)
+				vals.append(b)
+		if n > 1:
+			self.__check_count(n, len(vals) // 2)
+			self.__index_ngrams(n, ids, vals)
+		if n != self.n:
+			raise RuntimeError("%d-grams marker not found" % (n + 1))
+		self.ngmap = [wordmap]
+		for m in range(1, self.n):
+			self.ngmap.append(self.NGramIndex(self, m))
+		self.succmap = self.SuccessorIndex(self)
+
+	def __check_count(self, n, count):
+		"""
+		Check that the number of N-grams of order n that were read
+		matches the count in the \\data\\ header.
+		"""
+		if count != self.ng_counts[n]:
+			raise RuntimeError("Found %d %d-grams, expected %d" % (count, n, self.ng_counts[n]))
+
+	def __index_ngrams(self, n, ids, vals):
+		"""
+		Compute the keys of N-grams of order n from their word IDs,
+		and sort the N-grams by the key.  The N-grams of the lower
+		orders have to be indexed already.  Histories that are not in
+		the model are added by __add_histories().
+		"""
+		if len(self.ngkeys) != n - 1:
+			raise RuntimeError("%d-grams found before %d-grams" % (n, len(self.ngkeys) + 1))
+		vocab_size = len(self.widmap)
+		ids = numpy.frombuffer(ids, 'i8').reshape(-1, n)
+		vals = numpy.frombuffer(vals, 'd').reshape(-1, 2)
+		ctxids = ids[:,0]
+		for m in range(1, n-1):
+			query = ctxids * vocab_size + ids[:,m]
+			ctxids = self.ngkeys[m].searchsorted(query)
+			found = ctxids < len(self.ngkeys[m])
+			found[found] = self.ngkeys[m][ctxids[found]] == query[found]
+			if not found.all():
+				self.__add_histories(m, numpy.unique(ids[~found,:m+1], axis=0))
+				ctxids = self.ngkeys[m].searchsorted(query)
+		keys = ctxids * vocab_size + ids[:,n-1]
+		order = keys.argsort(kind='stable')
+		self.ngkeys.append(keys[order])
+		self.ngrams.append(vals[order])
+		self.ngadded.append(numpy.zeros(0, 'i8'))
+
+	def __add_histories(self, m, ids):
+		"""
+		Add N-grams of order M+1, given as rows of word IDs, to the
+		model as histories of higher order N-grams, like KenLM does.
+		Their histories have to exist already.  An ARPA file may omit
+		the history of an N-gram, in which case the history has the
+		backoff weight 1.  The added N-grams get the backoff weight 1
+		and the probability that is obtained by backing off, so the
+		probabilities given by the model don't change.  They are not
+		shown by ngram(), mgrams(), successors(), or save().
+		"""
+		vocab_size = len(self.widmap)
+		ctxids = self.__find_rows(ids[:,:-1])
+		keys = ctxids * vocab_size + ids[:,-1]
+		vals = numpy.zeros((len(ids), 2))
+		vals[:,0] = self.__backoff_probs(ids)
+		num_old = len(self.ngkeys[m])
+		all_keys = numpy.concatenate([self.ngkeys[m], keys])
+		order = all_keys.argsort(kind='stable')
+		new_ids = numpy.empty(len(order), 'i8')
+		new_ids[order] = numpy.arange(len(order))
+		self.ngkeys[m] = all_keys[order]
+		self.ngrams[m] = numpy.concatenate([self.ngrams[m], vals])[order]
+		self.ngadded[m] = numpy.sort(numpy.concatenate(
+			[new_ids[self.ngadded[m]], new_ids[num_old:]]))
+		# The IDs of the old N-grams changed, so the keys of the next
+		# order have to be updated.  Their order doesn't change.
+		if m + 1 < len(self.ngkeys):
+			keys = self.ngkeys[m+1]
+			self.ngkeys[m+1] = new_ids[keys // vocab_size] * vocab_size + keys % vocab_size
+
+	def __find_rows(self, ids):
+		"""
+		Find the IDs of N-grams given as rows of word IDs, or -1 for
+		the N-grams that are not in the model.
+		"""
+		ngids = ids[:,0]
+		for m in range(1, ids.shape[1]):
+			ngids = self.__find_successors(ngids, ids[:,m], m)
+		return ngids
+
+	def __backoff_probs(self, ids):
+		"""
+		Compute the log-probabilities of N-grams given as rows of
+		word IDs by backing off to the lower order, as if the
+		N-grams were not in the model.  The backoff weight of a
+		history that is not in the model is 1.
+		"""
+		n = ids.shape[1]
+		hist_ids = self.__find_rows(ids[:,:-1])
+		result = numpy.zeros(len(ids))
+		found = hist_ids >= 0
+		result[found] = self.ngrams[n-2][hist_ids[found],1]
+		if n == 2:
+			return result + self.ngrams[0][ids[:,-1],0]
+		lower = ids[:,1:]
+		lower_ids = self.__find_rows(lower)
+		found = lower_ids >= 0
+		result[found] += self.ngrams[n-2][lower_ids[found],0]
+		result[~found] += self.__backoff_probs(lower[~found])
+		return result
+
+	def _is_added(self, m, ngid):
+		"""
+		Check whether the N-gram of order M+1 with the given ID was
+		added by __add_histories().
+		"""
+		added = self.ngadded[m]
+		i = added.searchsorted(ngid)
+		return (i < len(added)) and (added[i] == ngid)
+
+	def _real_mask(self, m):
+		"""
+		Return a boolean array that tells which N-grams of order M+1
+		were read from the model file, i.e. not added by
+		__add_histories().
+		"""
+		result = numpy.ones(len(self.ngrams[m]), bool)
+		result[self.ngadded[m]] = False
+		return result
+
+	def read_parallel(self, path, processes=None):
+		"""
+		Load an ARPA format language model from an uncompressed file
+		using multiple processes.  The file is memory-mapped, and each
+		section is split into byte ranges that are parsed in parallel.
+		The N-grams are written directly to arrays that are shared
+		with the worker processes.
+		@param path: Path to the ARPA file.
+		@type path: string
+		@param processes: Number of worker processes.  By default, the
+						  number of CPUs.
+		@type processes: int
+		"""
+		global _parallel_read
+		if processes is None:
+			processes = os.cpu_count()
+		with open(path, 'rb') as fh:
+			mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+		# Get N-gram counts from the header
+		pos = mapping.find(b'\\data\\')
+		if pos < 0:
+			raise Exception("\\data\\ marker not found")
+		end = mapping.find(b'\n\\', pos)
+		self.ng_counts = {}
+		r = re.compile(r"ngram (\d+)=(\d+)")
+		for spam in mapping[pos:end].decode('utf-8').splitlines():
+			m = r.match(spam.strip())
+			if m != None:
+				n, c = list(map(int, m.groups()))
+				self.ng_counts[n] = c
+		self.n = max(self.ng_counts.keys())
+		# Find the sections and split them into byte ranges that start
+		# at the beginning of a line
+		sections = []
+		for n in range(1, self.n+1):
+			marker = b'\\%d-grams:' % n
+			pos = mapping.find(marker, end)
+			if pos < 0:
+				raise Exception("%d-grams marker not found" % n)
+			start = mapping.find(b'\n', pos) + 1
+			end = mapping.find(b'\n\\', start)
+			if end < 0:
+				raise Exception("\\end\\ marker not found")
+			while (end > start) and (mapping[end-1:end] in b' \t\r\n'):
+				end -= 1
+			sections.append(self.__split_section(mapping, start, end, processes * 4))
+
+		context = multiprocessing.get_context('fork')
+		_parallel_read = {'mapping': mapping}
+		try:
+			print("Reading %i 1-grams." % self.ng_counts[1])
+			self.widmap = []
+			vals = []
+			with context.Pool(processes) as pool:
+				for words, chunk_vals in pool.imap(_read_unigram_lines, sections[0]):
+					self.widmap.extend(words)
+					vals.append(chunk_vals)
+			self.ngrams = [numpy.concatenate(vals) if vals else numpy.zeros((0,2))]
+			self.ngkeys = [None]
+			self.ngadded = [numpy.zeros(0, 'i8')]
+			self.__check_count(1, len(self.widmap))
+			wordmap = {}
+			for wordid, w in enumerate(self.widmap):
+				wordmap[w] = wordid
+			if len(wordmap) != len(self.widmap):
+				raise RuntimeError("Duplicate words in 1-grams")
+
+			# Shared arrays for the word IDs, probabilities, and backoff
+			# weights of the N-grams of each order, in file order
+			_parallel_read['wordmap'] = wordmap
+			_parallel_read['ids'] = {}
+			_parallel_read['vals'] = {}
+			for n in range(2, self.n+1):
+				count = self.ng_counts[n]
+				buf = mmap.mmap(-1, max(count * n * 8, 1))
+				_parallel_read['ids'][n] = numpy.frombuffer(buf, 'i8', count * n).reshape(-1, n)
+				buf = mmap.mmap(-1, max(count * 16, 1))
+				_parallel_read['vals'][n] = numpy.frombuffer(buf, 'd', count * 2).reshape(-1, 2)
+			tasks = []
+			for n in range(2, self.n+1):
+				row = 0
+				for start, end in sections[n-1]:
+					tasks.append((n, start, end, row))
+					row += self.__count_lines(mapping, start, end, end == sections[n-1][-1][1])
+				if row != self.ng_counts[n]:
+					raise RuntimeError("Found %d %d-grams, expected %d" % (row, n, self.ng_counts[n]))
+			with context.Pool(processes) as pool:
+				for (n, start, end, row), count in zip(tasks, pool.imap(_read_ngram_lines, tasks)):
+					if count != self.__count_lines(mapping, start, end, end == sections[n-1][-1][1]):
+						raise RuntimeError("Empty lines in %d-gram section" % n)
+			for n in range(2, self.n+1):
+				print("Indexing %i %i-grams." % (self.ng_counts[n], n))
+				self.__index_ngrams(n, _parallel_read['ids'][n], _parallel_read['vals'][n])
+		finally:
+			_parallel_read = None
+		self.ngmap = [wordmap]
+		for m in range(1, self.n):
+			self.ngmap.append(self.NGramIndex(self, m))
+		self.succmap = self.SuccessorIndex(self)
 
-				# Successor list for N-1-Gram
-				mgram = tuple(ng[:-1])
-				self.succmap.setdefault(mgram, []).append(ng[-1])
-				ngramid += 1
+	@staticmethod
+	def __split_section(mapping, start, end, num_parts):
+		"""
+		Split a byte range into at most num_parts ranges that start at
+		the beginning of a line.
+		"""
+		result = []
+		step = max((end - start) // num_parts, 1)
+		while start < end:
+			split = mapping.find(b'\n', min(start + step, end), end)
+			split = end if split < 0 else split + 1
+			result.append((start, split))
+			start = split
+		return result
+
+	@staticmethod
+	def __count_lines(mapping, start, end, last):
+		"""
+		Count the lines in a byte range that has been created by
+		__split_section().  Only the last range of a section may end
+		without a newline.
+		"""
+		count = mapping[start:end].count(b'\n')
+		if last and (end > start) and (mapping[end-1:end] != b'\n'):
+			count += 1
+		return count
+
+	@staticmethod
+	def is_binary(path):
+		"""
+		Check whether a file is in the binary format written by
+		save_binary().
+		"""
+		with open(path, 'rb') as fh:
+			return fh.read(len(BINARY_MAGIC)) in (BINARY_MAGIC, BINARY_MAGIC_V1)
+
+	def read_binary(self, path):
+		"""
+		Load a language model from a file in the binary format
+		written by save_binary().  The file is memory-mapped, so
+		loading is fast and the memory is shared between processes
+		that load the same file.  Modifying the model does not change
+		the file.
+		@param path: Path to the binary model file.
+		@type path: string
+		"""
+		with open(path, 'rb') as fh:
+			self.mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_COPY)
+		magic, self.n, vocab_bytes = struct.unpack_from(BINARY_HEADER, self.mapping)
+		if magic not in (BINARY_MAGIC, BINARY_MAGIC_V1):
+			raise Exception("Not a binary language model file: " + path)
+		offset = struct.calcsize(BINARY_HEADER)
+		counts = struct.unpack_from('<%dQ' % self.n, self.mapping, offset)
+		offset += 8 * self.n
+		self.ng_counts = dict(enumerate(counts, 1))
+		if magic == BINARY_MAGIC:
+			num_added = struct.unpack_from('<%dQ' % self.n, self.mapping, offset)
+			offset += 8 * self.n
+		else:
+			num_added = (0,) * self.n
+		vocab = self.mapping[offset:offset+vocab_bytes].decode('utf-8')
+		self.widmap = vocab.split('\n')
+		offset += vocab_bytes + (-vocab_bytes) % 8
+		self.ngrams = []
+		self.ngkeys = [None]
+		self.ngadded = []
+		for n in range(1, self.n+1):
+			count = self.ng_counts[n] + num_added[n-1]
+			vals = numpy.frombuffer(self.mapping, '<f8', count * 2, offset)
+			self.ngrams.append(vals.reshape(count, 2))
+			offset += count * 16
+			if n > 1:
+				keys = numpy.frombuffer(self.mapping, '<i8', count, offset)
+				self.ngkeys.append(keys)
+				offset += count * 8
+			added = numpy.frombuffer(self.mapping, '<i8', num_added[n-1], offset)
+			self.ngadded.append(added)
+			offset += num_added[n-1] * 8
+		self.ngmap = [dict((w, i) for i, w in enumerate(self.widmap))]
+		for m in range(1, self.n):
+			self.ngmap.append(self.NGramIndex(self, m))
+		self.succmap = self.SuccessorIndex(self)
+
+	def save_binary(self, path):
+		"""
+		Save the language model in a binary format that can be
+		memory-mapped by read_binary().  Each N-Gram of order 2 or
+		higher is identified by a key, history ID times vocabulary
+		size plus word ID, where the history ID is the index of the
+		history in the arrays of the previous order.  The N-Grams of
+		each order are sorted by the key, and followed by the IDs of
+		the histories that were added by __add_histories().
+		@param path: Path to save the file to.
+		@type path: string
+		"""
+		vocab = '\n'.join(self.widmap).encode('utf-8')
+		with open(path, 'wb') as fh:
+			fh.write(struct.pack(BINARY_HEADER, BINARY_MAGIC, self.n, len(vocab)))
+			fh.write(struct.pack('<%dQ' % self.n, *[self.ng_counts[n] for n in range(1, self.n+1)]))
+			fh.write(struct.pack('<%dQ' % self.n, *[len(x) for x in self.ngadded]))
+			fh.write(vocab)
+			fh.write(b'\0' * ((-len(vocab)) % 8))
+			for n in range(1, self.n+1):
+				fh.write(numpy.ascontiguousarray(self.ngrams[n-1], '<f8').tobytes())
+				if n > 1:
+					fh.write(numpy.ascontiguousarray(self.ngkeys[n-1], '<i8').tobytes())
+				fh.write(numpy.ascontiguousarray(self.ngadded[n-1], '<i8').tobytes())
+
+	def _find_ngram(self, ng):
+		"""
+		Find the ID of an N-Gram in the sorted arrays, or -1 if the
+		N-Gram is not in the model.
+		"""
+		if isinstance(ng, str):
+			ng = (ng,)
+		return self._find_ids([self.ngmap[0].get(w, -1) for w in ng])
+
+	def _find_ids(self, wids):
+		"""
+		Find the ID of an N-Gram given as word IDs, or -1 if the
+		N-Gram is not in the model.  Words that are not in the
+		vocabulary are represented by -1.
+		"""
+		ngid = wids[0]
+		for m in range(1, len(wids)):
+			if (ngid < 0) or (m >= self.n):
+				return -1
+			ngid = self._find_successor(ngid, wids[m], m)
+		return ngid
+
+	def _find_successor(self, ctxid, wid, m):
+		"""
+		Find the ID of the N-Gram of order M+1 that consists of the
+		M-Gram with ID ctxid followed by word wid, or -1 if the
+		N-Gram is not in the model.
+		"""
+		if wid < 0:
+			return -1
+		key = ctxid * len(self.widmap) + wid
+		keys = self.ngkeys[m]
+		ngid = int(keys.searchsorted(key))
+		if (ngid == len(keys)) or (keys[ngid] != key):
+			return -1
+		return ngid
+
+	def _successor_range(self, words):
+		"""
+		Find the range of IDs of the successors of an M-Gram in the
+		sorted arrays of order M+1.
+		"""
+		if isinstance(words, str):
+			words = (words,)
+		m = len(words)
+		if (m == 0) or (m >= self.n):
+			return 0, 0
+		ctxid = self._find_ngram(words)
+		if ctxid < 0:
+			return 0, 0
+		vocab_size = len(self.widmap)
+		keys = self.ngkeys[m]
+		start, end = keys.searchsorted([ctxid * vocab_size, (ctxid + 1) * vocab_size])
+		return int(start), int(end)
+
+	def _successor_ids(self, words):
+		"""
+		Return the IDs of the successors of an M-Gram in the sorted
+		arrays of order M+1, excluding the N-grams that were added by
+		__add_histories().
+		"""
+		start, end = self._successor_range(words)
+		ngids = numpy.arange(start, end)
+		if start < end:
+			m = 1 if isinstance(words, str) else len(words)
+			added = self.ngadded[m]
+			first, last = added.searchsorted([start, end])
+			ngids = numpy.setdiff1d(ngids, added[first:last], assume_unique=True)
+		return ngids
+
+	def _ngram_tuples(self, m):
+		"""
+		Return the N-Grams of order M+1 in the sorted arrays, as a
+		list of word tuples indexed by ID.
+		"""
+		vocab_size = len(self.widmap)
+		result = [(w,) for w in self.widmap]
+		for k in range(1, m+1):
+			keys = self.ngkeys[k]
+			ctxids = (keys // vocab_size).tolist()
+			wids = (keys % vocab_size).tolist()
+			result = [result[h] + (self.widmap[w],) for h, w in zip(ctxids, wids)]
+		return result
+
+	def set_cache_size(self, size):
+		"""
+		Enable caching the results of prob() and score_word() for
+		the given number of most recently used queries, or disable
+		caching if size is None or 0.  The queries are identified
+		by word IDs, so the cache is small and effective also when
+		the histories are long.
+		"""
+		if size:
+			self.cache = self.QueryCache(size)
+		else:
+			self.cache = None
+
+	def cache_statistics(self):
+		"""
+		Return the number of entries in the cache, and the number of
+		hits, misses, and evictions since the cache was enabled, in
+		a dictionary, or None if caching is disabled.
+		"""
+		if self.cache is None:
+			return None
+		return self.cache.statistics()
 
 	def get_size(self):
 		"""
@@ -213,50 +880,112 @@ class ArpaLM(object):
 		"""
 		return len(self.ngmap)
 
-	def save(self, path):
+	def save(self, path, compresslevel=6, threaded=True):
 		"""
-		Save an ARPA format language model to a file.
+		Save an ARPA format language model to a file.  The N-grams
+		are written in the order of their IDs, and formatted a chunk
+		at a time.
   
 		@param path: Path to save the file to.  If this ends in '.gz',
 					 the file contents will be gzip-compressed.
 		@type path: string
+		@param compresslevel: gzip compression level.
+		@type compresslevel: int
+		@param threaded: If True, a gzip-compressed file is
+						 compressed in a background thread, while
+						 the next chunk is being formatted.
+		@type threaded: bool
 		"""
 		if path.endswith('.gz'):
-			fh = gzip.open(path, 'w')
+			fh = gzip.open(path, 'wb', compresslevel=compresslevel)
 		else:
-			fh = open(path, 'w')
-		fh.write("# Written by arpalm.py\n")
-		fh.write("\\data\\\n")
+			fh = open(path, 'wb')
+			threaded = False
+		if not threaded:
+			with fh:
+				for data in self.__arpa_chunks():
+					fh.write(data)
+			return
+
+		chunks = queue.Queue(maxsize=4)
+		errors = []
+		def write_chunks():
+			while True:
+				data = chunks.get()
+				if data is None:
+					break
+				# After an error, keep consuming the chunks so that the
+				# main thread doesn't block.
+				if not errors:
+					try:
+						fh.write(data)
+					except Exception as e:
+						errors.append(e)
+		thread = threading.Thread(target=write_chunks)
+		thread.start()
+		try:
+			for data in self.__arpa_chunks():
+				if errors:
+					break
+				chunks.put(data)
+		finally:
+			chunks.put(None)
+			thread.join()
+			fh.close()
+		if errors:
+			raise errors[0]
+
+	def __arpa_chunks(self, chunk_size=100000):
+		"""
+		Generate the contents of an ARPA file in chunks of UTF-8
+		encoded text.
+		"""
+		header = "# Written by arpalm.py\n\\data\\\n"
 		for n in range(1, self.n+1):
-			fh.write("ngram %d=%d\n" % (n, self.ng_counts[n]))
+			header += "ngram %d=%d\n" % (n, self.ng_counts[n])
+		yield header.encode('utf-8')
+		neginf = re.compile(r"^-inf(?=\s)|(?<=\t)-inf$", re.MULTILINE)
+		vocab = numpy.array(self.widmap, dtype=object)
 		for n in range(1, self.n+1):
-			fh.write("\n\\%d-grams:\n" % n)
-			ngrams = list(self.ngmap[n-1].keys())
-			ngrams.sort()
-			if '<unk>' in self.ngmap[n-1]:
-				ngid = self.ngmap[n-1]['<unk>']
-				score, bowt = self.ngrams[n-1][ngid]
-				score *= LOGTOLOG10
-				bowt *= LOGTOLOG10
+			yield ("\n\\%d-grams:\n" % n).encode('utf-8')
+			# The histories that were added when reading the model are
+			# not written.
+			real = numpy.flatnonzero(self._real_mask(n-1))
+			for start in range(0, len(real), chunk_size):
+				ngids = real[start:start+chunk_size]
+				words = self.__ngram_words(n, ngids, vocab)
+				scores = (self.ngrams[n-1][ngids,0] * LOGTOLOG10).tolist()
 				if n == self.n:
-					fh.write("%.4f <unk>\n" % (score))
+					text = ''.join(["%.4f %s\n" % x for x in zip(scores, words)])
 				else:
-					fh.write("%.4f <unk>\t%.4f\n" % (score,bowt))
-			for g in ngrams:
-				if g == '<unk>':
-					continue
-				ngid = self.ngmap[n-1][g]
-				score, bowt = self.ngrams[n-1][ngid]
-				score *= LOGTOLOG10
-				bowt *= LOGTOLOG10
-				if n > 1:
-					g = " ".join(g) 
-				if n == self.n:
-					fh.write("%.4f %s\n" % (score, g))
-				else:
-					fh.write("%.4f %s\t%.4f\n" % (score, g, bowt))
-		fh.write("\n\\end\\\n")
-		fh.close()
+					bowts = (self.ngrams[n-1][ngids,1] * LOGTOLOG10).tolist()
+					text = ''.join(["%.4f %s\t%.4f\n" % x for x in zip(scores, words, bowts)])
+				if '-inf' in text:
+					text = neginf.sub(LOG0STR, text)
+				yield text.encode('utf-8')
+		yield "\n\\end\\\n".encode('utf-8')
+
+	def __ngram_words(self, n, ngids, vocab):
+		"""
+		Return the N-grams of order n with the given IDs, as strings
+		of space-separated words.
+		"""
+		columns = vocab[self.__ngram_ids(n, ngids)].T.tolist()
+		return [' '.join(x) for x in zip(*columns)]
+
+	def __ngram_ids(self, n, ngids):
+		"""
+		Return the N-grams of order n with the given IDs, as rows of
+		word IDs.
+		"""
+		vocab_size = len(self.widmap)
+		result = numpy.empty((len(ngids), n), 'i8')
+		for m in range(n-1, 0, -1):
+			keys = self.ngkeys[m][ngids]
+			result[:,m] = keys % vocab_size
+			ngids = keys // vocab_size
+		result[:,0] = ngids
+		return result
 
 	def ngram(self, word, *hist):
 		"""
@@ -280,10 +1009,10 @@ class ArpaLM(object):
 		@return: Iterator over N-Grams
 		@rtype: generator(NGram)
 		"""
-		for ng, ngid in list(self.ngmap[m].items()):
-			if isinstance(ng, str):
-				ng = (ng,)
-			yield self.NGram(ng, *self.ngrams[m][ngid,:])
+		real = self._real_mask(m)
+		for ngid, ng in enumerate(self._ngram_tuples(m)):
+			if real[ngid]:
+				yield self.NGram(ng, *self.ngrams[m][ngid,:])
 
 	def successor_words(self, words):
 		"""
@@ -298,9 +1027,9 @@ class ArpaLM(object):
 			words = (words,)
 		else:
 			words = tuple(words)
-		if words in self.succmap:
-			for w in self.succmap[words]:
-				yield w
+		vocab_size = len(self.widmap)
+		for ngid in self._successor_ids(words):
+			yield self.widmap[self.ngkeys[len(words)][ngid] % vocab_size]
 
 	def successors(self, ng):
 		"""
@@ -311,12 +1040,12 @@ class ArpaLM(object):
 		@return: An iterator over all (M+1)-Gram successors to ng.
 		@rtype: generator(NGram)
 		"""
-		if ng.words in self.succmap:
-			for w in self.succmap[ng.words]:
-				succ = ng.words + (w,)
-				ngid = self.ngmap[len(succ)-1][succ]
-				yield self.NGram(ng.words + (w,),
-								 *self.ngrams[len(succ)-1][ngid])
+		m = len(ng.words)
+		vocab_size = len(self.widmap)
+		for ngid in self._successor_ids(ng.words):
+			w = self.widmap[self.ngkeys[m][ngid] % vocab_size]
+			yield self.NGram(ng.words + (w,),
+							 *self.ngrams[m][ngid])
 
 	def score(self, *syms):
 		p = self.prob(*syms)
@@ -332,43 +1061,209 @@ class ArpaLM(object):
 		@rtype: float
 		"""
 		syms = syms[0:min(len(syms),self.n)]
-		# It makes the most sense to do this recursively
 		n = len(syms)
-		if n == 1:
-			if syms[0] in self.ngmap[0]:
-				# 1-Gram exists, just return its probability
-				return self.ngrams[0][self.ngmap[0][syms[0]]][0]
-			elif '<unk>' in self.ngmap[0]:
-				# Use <unk>
-				return self.ngrams[0][self.ngmap[0]['<unk>']][0]
+		wids = [self.ngmap[0].get(w, -1) for w in syms]
+		if self.cache is not None:
+			key = tuple(wids)
+			result = self.cache.get(key)
+			if result is not None:
+				return result
+		# hist_ids[k-1] is the ID of the history of length k
+		hist_ids = [self._find_ids(wids[k:0:-1]) for k in range(1, n)]
+		result = self.__score(hist_ids, wids[0], syms[0])
+		if self.cache is not None:
+			self.cache.put(key, result)
+		return result
+
+	def initial_state(self, history=('<s>',)):
+		"""
+		Return the state for scoring words that follow the given
+		history with score_word().
+
+		@param history: The history in forward order.  By default the
+						sentence start.
+		@type history: sequence of str
+		@return: A state that identifies the contexts of the history
+				 that exist in the model.
+		@rtype: tuple(int)
+		"""
+		state = (-2,) * (self.n - 1)
+		for word in history:
+			state = self.__next_state(state, self.ngmap[0].get(word, -1))
+		return state
+
+	def score_word(self, state, word):
+		"""
+		Return the language model log-probability of a word that
+		follows a history, and the state after the word.  The result
+		is the same as that of prob() with the full history, but the
+		cost does not depend on the length of the history.
+
+		@param state: The state of the history, as returned by
+					  initial_state() or score_word().
+		@type state: tuple(int)
+		@return: The log probability in base e (natural log), and the
+				 new state.
+		@rtype: (float, tuple(int))
+		"""
+		wid = self.ngmap[0].get(word, -1)
+		if self.cache is not None:
+			key = (state, wid)
+			result = self.cache.get(key)
+			if result is not None:
+				return result
+		result = self.__score(state, wid, word), self.__next_state(state, wid)
+		if self.cache is not None:
+			self.cache.put(key, result)
+		return result
+
+	def __next_state(self, state, wid):
+		"""
+		Compute the state after word ID wid.  State element k-1 is
+		the ID of the history of length k, -1 if the history doesn't
+		exist in the model, or -2 if the history is shorter.  If the
+		previous word is not in the vocabulary, element 0 is -1.
+		"""
+		new_state = [wid]
+		for m in range(1, self.n - 1):
+			if state[m-1] >= 0:
+				new_state.append(self._find_successor(state[m-1], wid, m))
 			else:
-				raise self.OOVError(syms[0])
+				new_state.append(-1)
+		return tuple(new_state[:self.n - 1])
+
+	def __score(self, hist_ids, wid, word):
+		"""
+		Compute the log-probability of word ID wid, given the IDs of
+		its histories (see __next_state()).
+		"""
+		unkid = self.ngmap[0].get('<unk>', -1)
+		# Start from the longest N-Gram and back off until one is
+		# found, collecting the backoff weights of the histories.
+		bowts = []
+		for m in range(len(hist_ids), 0, -1):
+			hist_id = hist_ids[m-1]
+			if hist_id >= 0:
+				ngid = self._find_successor(hist_id, wid, m)
+				if ngid >= 0:
+					return self.__add_backoff(bowts, self.ngrams[m][ngid,0])
+			# Try to back off to <unk> if the history word doesn't
+			# exist
+			if (m == 1) and (hist_id == -1):
+				hist_id = unkid
+			if hist_id >= 0:
+				bowts.append(self.ngrams[m-1][hist_id,1])
+		if wid >= 0:
+			# 1-Gram exists, just return its probability
+			return self.__add_backoff(bowts, self.ngrams[0][wid,0])
+		elif unkid >= 0:
+			# Use <unk>
+			return self.__add_backoff(bowts, self.ngrams[0][unkid,0])
 		else:
-			# Forward N-gram (since syms is reversed)
-			fsyms = tuple(reversed(syms))
-			if fsyms in self.ngmap[n-1]:
-				# N-Gram exists, just return its probability
-				return self.ngrams[n-1][self.ngmap[n-1][fsyms]][0]
-			else:
-				# Backoff: alpha(history) * probability (N-1-Gram)
-				fhist = fsyms[:-1]
-				# New N-1 gram symbols (reversed order)
-				syms = syms[:-1]
-				# Treat unigram histories a bit specially
-				if len(fhist) == 1:
-					fhist = fhist[0]
-					# Try to back off to <unk> if word doesn't exist -
-					# if this is a closed vocab model this will just
-					# return the unigram prob for syms[0]
-					if not fhist in self.ngmap[0]:
-						fhist = '<unk>'
-				if fhist in self.ngmap[n-2]:
-					# Try to use the history if it exists
-					bowt = self.ngrams[n-2][self.ngmap[n-2][fhist]][1]
-					return bowt + self.prob(*syms)
-				else:
-					# Otherwise back off some more
-					return self.prob(*syms)
+			raise self.OOVError(word)
+
+	@staticmethod
+	def __add_backoff(bowts, prob):
+		# Add the backoff weights starting from the shortest history.
+		for bowt in reversed(bowts):
+			prob = bowt + prob
+		return prob
+
+	def word_ids(self, words):
+		"""
+		Convert a sequence of words to an array of word IDs, for
+		batch_prob().  Words that are not in the vocabulary are
+		represented by -1.
+		"""
+		return numpy.array([self.ngmap[0].get(w, -1) for w in words], 'i8')
+
+	def batch_prob(self, sentences):
+		"""
+		Return the language model log-probabilities of the words in
+		a batch of sentences.  The probabilities are computed with
+		array operations, one pass per order, and are the same that
+		prob() would return for each word.
+
+		@param sentences: Word ID arrays (see word_ids()).  The
+						  first word of each sentence is not scored,
+						  so the sentences should start with <s>.
+		@type sentences: sequence of numpy.ndarray
+		@return: The log probabilities of all but the first word of
+				 each sentence, concatenated, in base e.  If a word
+				 is not in the vocabulary and the model does not
+				 contain <unk>, the log probability is -inf.
+		@rtype: numpy.ndarray
+		"""
+		sentences = [numpy.asarray(x, 'i8') for x in sentences]
+		if not sentences:
+			return numpy.zeros(0)
+		lengths = numpy.array([len(x) for x in sentences])
+		tokens = numpy.concatenate(sentences)
+		starts = numpy.cumsum(lengths) - lengths
+		positions = numpy.arange(len(tokens)) - numpy.repeat(starts, lengths)
+		targets = numpy.flatnonzero(positions > 0)
+		# wids[:,k] is the word k positions before the scored word, or
+		# -2 at the beginning of a sentence.
+		wids = numpy.full((len(targets), self.n), -2, 'i8')
+		for k in range(self.n):
+			avail = positions[targets] >= k
+			wids[avail,k] = tokens[targets[avail] - k]
+		return self.__batch_prob(wids)
+
+	def __batch_prob(self, wids):
+		"""
+		Return the log-probabilities of a matrix of N-Grams, each
+		row containing the word IDs in reverse order, as in prob().
+		"""
+		count = wids.shape[0]
+		unkid = self.ngmap[0].get('<unk>', -1)
+		# hist_ids[k] contains the IDs of the histories of length k
+		hist_ids = [None]
+		for k in range(1, self.n):
+			ctxids = wids[:,k]
+			for j in range(k-1, 0, -1):
+				ctxids = self.__find_successors(ctxids, wids[:,j], k-j)
+			hist_ids.append(ctxids)
+		# Find the longest N-Gram that exists in the model; level is
+		# the order minus one.
+		probs = numpy.zeros(count)
+		levels = numpy.full(count, -1)
+		for m in range(self.n-1, 0, -1):
+			ngids = self.__find_successors(hist_ids[m], wids[:,0], m)
+			found = (levels < 0) & (ngids >= 0)
+			probs[found] = self.ngrams[m][ngids[found],0]
+			levels[found] = m
+		unigrams = levels < 0
+		levels[unigrams] = 0
+		uids = numpy.where(wids[:,0] >= 0, wids[:,0], unkid)
+		oovs = unigrams & (uids < 0)
+		unigrams &= ~oovs
+		probs[unigrams] = self.ngrams[0][uids[unigrams],0]
+		probs[oovs] = float("-inf")
+		# Add the backoff weights of the histories that were backed
+		# off from, starting from the shortest history.  Unigram
+		# histories that don't exist back off to <unk>.
+		for m in range(1, self.n):
+			hids = hist_ids[m]
+			if m == 1:
+				hids = numpy.where(wids[:,1] == -1, unkid, hids)
+			backoff = (levels < m) & (hids >= 0)
+			probs[backoff] = self.ngrams[m-1][hids[backoff],1] + probs[backoff]
+		return probs
+
+	def __find_successors(self, ctxids, wids, m):
+		"""
+		Vectorized version of _find_successor().
+		"""
+		keys = self.ngkeys[m]
+		result = numpy.full(len(ctxids), -1, 'i8')
+		valid = numpy.flatnonzero((ctxids >= 0) & (wids >= 0))
+		query = ctxids[valid] * len(self.widmap) + wids[valid]
+		ngids = keys.searchsorted(query)
+		found = ngids < len(keys)
+		found[found] = keys[ngids[found]] == query[found]
+		result[valid[found]] = ngids[found]
+		return result
 
 	def adapt_rescale(self, unigram, vocab=None):
 		"""Update unigram probabilities with unigram (assumed to be in
@@ -377,52 +1272,47 @@ class ArpaLM(object):
 		as the original vocabulary, you must pass vocab, which is a
 		list of the words in unigram, in the same order as their
 		probabilities are listed in unigram."""
-		if vocab:
-			# Construct a temporary list mapping for the unigrams
-			vmap = [self.ngmap[0][w] for w in vocab]
-			# Get the original unigrams
-			og = numpy.exp(self.ngrams[0][:,0].take(vmap))
-			# Compute the individual scaling factors
-			ascale = unigram * og.sum() / og
-			# Put back the normalized version of unigram
-			self.ngrams[0][:,0].put(numpy.log(unigram * og.sum()), vmap)
-			# Now reconstruct vocab as a dictionary mapping words to
-			# scaling factors
-			vv = {}
-			for i, w in enumerate(vocab):
-				vv[w] = i
-			vocab = vv
-		else:
-			ascale = unigram / numpy.exp(self.ngrams[0][:,0])
-			self.ngrams[0][:,0] = numpy.log(unigram)
-  
-		for n in range(1, self.n):
-			# Total discounted probabilities for each history
-			tprob = numpy.zeros(self.ngrams[n-1].shape[0], 'd')
-			# Rescaled total probabilities
-			newtprob = numpy.zeros(self.ngrams[n-1].shape[0], 'd')
-			# For each N-gram, accumulate and rescale
-			for ng,idx in list(self.ngmap[n].items()):
-				h = ng[0:-1]
-				if n == 1: # Quirk of unigrams
-					h = h[0]
-				w = ng[-1]
-				prob = numpy.exp(self.ngrams[n][idx,0])
-				tprob[self.ngmap[n-1][h]] += prob
-				if vocab == None or w in vocab:
-					prob = prob * ascale[vocab[w]]
-				newtprob[self.ngmap[n-1][h]] += prob
-				self.ngrams[n][idx,0] = numpy.log(prob)
-			# Now renormalize everything
-			norm = tprob / newtprob
-			for ng,idx in list(self.ngmap[n].items()):
-				h = ng[0:-1]
-				if n == 1: # Quirk of unigrams
-					h = h[0]
-				w = ng[-1]
-				prob = numpy.exp(self.ngrams[n][idx,0])
-				self.ngrams[n][idx,0] = numpy.log(prob * norm[self.ngmap[n-1][h]])
+		if self.cache is not None:
+			self.cache.clear()
+		unigram = numpy.asarray(unigram, 'd')
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			if vocab:
+				# Construct a temporary list mapping for the unigrams
+				vmap = numpy.array([self.ngmap[0][w] for w in vocab])
+				# Get the original unigrams
+				og = numpy.exp(self.ngrams[0][vmap,0])
+				# Compute the scaling factor of each word; words that
+				# are not in vocab are not scaled
+				ascale = numpy.ones(len(self.widmap))
+				ascale[vmap] = unigram * og.sum() / og
+				# Put back the normalized version of unigram
+				self.ngrams[0][vmap,0] = numpy.log(unigram * og.sum())
+			else:
+				ascale = unigram / numpy.exp(self.ngrams[0][:,0])
+				self.ngrams[0][:,0] = numpy.log(unigram)
 
+			vocab_size = len(self.widmap)
+			for n in range(1, self.n):
+				# The histories that were added when reading the
+				# model are not included in the totals.
+				real = self._real_mask(n)
+				hids = self.ngkeys[n][real] // vocab_size
+				wids = self.ngkeys[n][real] % vocab_size
+				num_histories = self.ngrams[n-1].shape[0]
+				prob = numpy.exp(self.ngrams[n][real,0])
+				# Total discounted probabilities for each history
+				tprob = numpy.bincount(hids, prob, num_histories)
+				# Rescaled total probabilities
+				prob *= ascale[wids]
+				newtprob = numpy.bincount(hids, prob, num_histories)
+				# Now renormalize everything
+				norm = tprob / newtprob
+				self.ngrams[n][real,0] = numpy.log(prob * norm[hids])
+			# The added histories get again the probabilities obtained
+			# by backing off.  The lower orders are updated first.
+			for n in range(1, self.n):
+				ids = self.__ngram_ids(n + 1, self.ngadded[n])
+				self.ngrams[n][self.ngadded[n],0] = self.__backoff_probs(ids)
 
 	def getProbability(self, history, word):
 		#history.append(word)
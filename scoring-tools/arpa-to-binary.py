@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Converts an ARPA language model to the binary format of ArpaLM. The binary
+# model is memory-mapped when it is loaded, so loading it is fast, and
+# processes that load the same model share the memory.
+
+import argparse
+import sys
+from contextlib import redirect_stdout
+from ArpaLM import ArpaLM
+
+parser = argparse.ArgumentParser()
+parser.add_argument('input', type=str, help='arpa language model file')
+parser.add_argument('output', type=str, help='binary language model file')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='read an uncompressed arpa file using this many processes')
+args = parser.parse_args()
+
+with redirect_stdout(sys.stderr):
+	lm = ArpaLM(args.input, processes=args.jobs)
+lm.save_binary(args.output)
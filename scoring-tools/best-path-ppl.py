@@ -17,141 +17,131 @@
 
 import argparse
 import math
-from copy import copy, deepcopy
+import multiprocessing
 from filetypes import TextFileType
 from ArpaLM import ArpaLM
-from transcripts import Transcripts
-
-class Path:
-	def __init__(self):
-		self.__history = ['<s>']
-		self.__logprob = 0
-
-	def __repr__(self):
-		return str(self.logprob()) + ' ' + ' '.join(self.history())
-
-	def history(self):
-		return self.__history
-
-	def logprob(self):
-		return self.__logprob
-
-	def append(self, word, lm):
-		self.__history.append(word)
-		word_logprob = lm.prob(*reversed(self.history()))
-		if word_logprob == float('-inf'):
-			raise ArpaLM.OOVError(word)
-		self.__logprob += word_logprob
-
-class AlternativePaths:
-	def __init__(self, lm):
-		self.lm = lm
-		self.alternatives = [Path()]
-
-	def __repr__(self):
-		return '\n'.join([str(x) for x in self.alternatives])
-
-	# Appends a word to all alternatives.
-	def append(self, word):
-		for i in range(len(self.alternatives) - 1, -1, -1):
-			try:
-				self.alternatives[i].append(word, lm)
-			except ArpaLM.OOVError:
-				del self.alternatives[i]
-
-	# Appends each word sequence to all alternatives.
-	# '@' represents the NULL word.
-	def extend(self, seqs):
-		# This way we don't have multiple copies of old alternatives
-		# even if there are multiple @ (NULL) words. We still need to
-		# copy self.alternatives, though. Otherwise extending
-		# new_alternatives will extend self.alternatives as well.
-		if ['@'] in seqs:
-			new_alternatives = copy(self.alternatives)
-		else:
-			new_alternatives = []
-
-		for seq in seqs:
-			if seq == ['@']:
-				continue
-			for alt in self.alternatives:
+from transcripts import trn_utterances, transcript_graph
+
+# Finds the path through a transcript that has the highest language model
+# probability. The transcript is compiled into a word graph, and the best path
+# is found by Viterbi search over (node, LM state) pairs. Paths that reach the
+# same node in the same LM state are recombined, so the search time is linear
+# in the length of the transcript. Paths are stored as back pointers, without
+# copying histories. If max_lm_states is given, only that many best LM states
+# are kept at each node. Returns the log probability and the word
+# sequence of the best path, or None if no path could be scored.
+def best_path(lm, transcript, max_lm_states=None):
+	num_nodes, links = transcript_graph(transcript + ['</s>'])
+	# For each node, maps LM states to the best (log probability, back
+	# pointer) pair. A back pointer is a (back pointer, word) pair.
+	hyps = [dict() for node in range(num_nodes)]
+	hyps[0][lm.initial_state()] = (0, None)
+	node = -1
+	for start, end, word in links:
+		if start != node:
+			if node >= 0:
+				hyps[node] = None
+			node = start
+			if (max_lm_states is not None) and (len(hyps[node]) > max_lm_states):
+				best = sorted(hyps[node].items(), key=lambda x: x[1][0], reverse=True)
+				hyps[node] = dict(best[:max_lm_states])
+		for state, (logprob, back) in hyps[start].items():
+			if word is not None:
 				try:
-					new_alt = deepcopy(alt)
-					for word in seq:
-						new_alt.append(word, lm)
-					new_alternatives.append(new_alt)
+					word_logprob, new_state = lm.score_word(state, word)
 				except ArpaLM.OOVError:
-					pass
-
-		self.alternatives = new_alternatives
-
-	# Prunes worst alternatives, leaving a maximum of max_alternatives.
-	def prune(self, max_alternatives):
-		if len(self.alternatives) > max_alternatives:
-			self.alternatives.sort(key=lambda x: x.logprob(), reverse=True)
-			self.alternatives = self.alternatives[:max_alternatives]
-
-	def size(self):
-		return len(self.alternatives)
+					continue
+				if word_logprob == float('-inf'):
+					continue
+				new_logprob = logprob + word_logprob
+				new_back = (back, word)
+			else:
+				new_state, new_logprob, new_back = state, logprob, back
+			old = hyps[end].get(new_state)
+			if (old is None) or (new_logprob > old[0]):
+				hyps[end][new_state] = (new_logprob, new_back)
+
+	if not hyps[-1]:
+		return None
+	logprob, back = max(hyps[-1].values(), key=lambda x: x[0])
+	words = []
+	while back is not None:
+		back, word = back
+		words.append(word)
+	words.append('<s>')
+	words.reverse()
+	return logprob, words
+
+# Finds the best path through the transcript of an utterance, and counts the
+# words in it. Returns the utterance ID, the log probability and the word
+# sequence of the best path, and the number of words, or None in place of the
+# path if the transcript could not be scored.
+def score_utterance(utterance):
+	utterance_id, transcript = utterance
+	if (len(transcript) >= 2) and (transcript[0] == '<s>') and (transcript[-1] == '</s>'):
+		transcript = transcript[1:-1]
 
-	def best(self):
-		if len(self.alternatives) > 0:
-			return max(self.alternatives, key=lambda x: x.logprob())
-		else:
-			return None
+	best_alternative = best_path(lm, transcript, args.max_lm_states)
+	if best_alternative is None:
+		return utterance_id, None, 0
+
+	# When using subword models, the transcripts always contain a word boundary
+	# after the initial <s> and before the final </s>. There may be two
+	# consecutive word boundaries, at least if the transcript is empty. We
+	# remove first consecutive word boundary symbols.
+	best_words = best_alternative[1]
+	hist = [x for i, x in enumerate(best_words) if best_words[i:i+2] != ['<w>', '<w>']]
+
+	# Now the number of word boundaries equals to the number of words, omitting
+	# the initial sentence start, or in case of a word model, the number of
+	# tokens minus one.
+	num_word_boundaries = hist.count('<w>')
+	if num_word_boundaries >= 1:
+		return utterance_id, best_alternative, num_word_boundaries
+	else:
+		return utterance_id, best_alternative, len(hist) - 1
 
 parser = argparse.ArgumentParser()
-parser.add_argument('lm', type=TextFileType('r'), help='arpa language model file')
+parser.add_argument('lm', type=str, help='arpa language model file, or a binary model written by arpa-to-binary.py')
 parser.add_argument('trn', type=TextFileType('r'), help='transcript file')
-parser.add_argument('--max-alternatives', type=int, default=None, help='maximum number of best alternatives to keep in memory at a time')
+parser.add_argument('--max-lm-states', '--max-alternatives', dest='max_lm_states', type=int, default=None, help='maximum number of best language model states to keep at each position of the transcript (the search is exact without a limit; --max-alternatives is an old name of this option, which used to limit the number of alternative paths through the transcript)')
+parser.add_argument('--cache-size', type=int, default=None, help='cache this many language model queries')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='score the utterances using this many processes; the language model is loaded once and shared')
 args = parser.parse_args()
 
-lm = ArpaLM(args.lm)
-args.lm.close()
+lm = ArpaLM(args.lm, cache_size=args.cache_size)
 
-trn = Transcripts()
-trn.read_trn(args.trn)
-args.trn.close()
+# The transcripts are read and scored one utterance at a time.
+utterances = trn_utterances(args.trn)
+
+if args.jobs > 1:
+	# The worker processes are forked after the language model has been
+	# loaded, so they share its memory. The results are returned in the
+	# input order, and the workers are kept busy while the results are
+	# written.
+	pool = multiprocessing.get_context('fork').Pool(args.jobs)
+	results = pool.imap(score_utterance, utterances, chunksize=16)
+else:
+	pool = None
+	results = map(score_utterance, utterances)
 
 logprob_sum = 0
 num_words = 0
 num_rejected_sentences = 0
-for utterance_id, transcript in trn:
-	alternatives = AlternativePaths(lm)
-	if (len(transcript) >= 2) and (transcript[0] == '<s>') and (transcript[-1] == '</s>'):
-		transcript = transcript[1:-1]
-	for token in transcript:
-		if type(token) is list:
-			alternatives.extend(token)
-		else:
-			alternatives.append(token)
-		if args.max_alternatives is not None:
-			alternatives.prune(args.max_alternatives)
-	alternatives.append('</s>')
-
-	best_alternative = alternatives.best()
+for utterance_id, best_alternative, utterance_num_words in results:
 	if best_alternative is not None:
-		# When using subword models, the transcripts always contain a word boundary
-		# after the initial <s> and before the final </s>. There may be two
-		# consecutive word boundaries, at least if the transcript is empty. We
-		# remove first consecutive word boundary symbols.
-		hist = best_alternative.history()
-		hist = [x for i, x in enumerate(hist) if hist[i:i+2] != ['<w>', '<w>']]
-
-		# Now the number of word boundaries equals to the number of words, omitting
-		# the initial sentence start, or in case of a word model, the number of
-		# tokens minus one.
-		num_word_boundaries = hist.count('<w>')
-		if num_word_boundaries >= 1:
-			num_words += num_word_boundaries
-		else:
-			num_words += len(hist) - 1
-
-		logprob_sum += best_alternative.logprob()
-		print(best_alternative, '(' + str(utterance_id) + ')')
+		best_logprob, best_words = best_alternative
+		num_words += utterance_num_words
+		logprob_sum += best_logprob
+		print(best_logprob, ' '.join(best_words), '(' + str(utterance_id) + ')')
 	else:
 		num_rejected_sentences += 1
 
+args.trn.close()
+if pool is not None:
+	pool.close()
+	pool.join()
+
 logprob_sum_base2 = logprob_sum / math.log(2)
 logprob_sum_base10 = logprob_sum / math.log(10)
 
@@ -161,6 +151,12 @@ print('logprob_sum:', logprob_sum)
 print('logprob_sum_base2:', logprob_sum_base2)
 print('logprob_sum_base10:', logprob_sum_base10)
 
+# With multiple jobs, the queries are cached in the worker processes.
+cache_statistics = lm.cache_statistics()
+if (cache_statistics is not None) and (pool is None):
+	for name in ['size', 'hits', 'misses', 'evictions', 'hit_rate']:
+		print('cache_' + name + ':', cache_statistics[name])
+
 if num_words > 0:
 	cross_entropy = -logprob_sum / num_words
 	cross_entropy_base2 = -logprob_sum_base2 / num_words
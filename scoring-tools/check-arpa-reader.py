@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Syntax: check-arpa-reader.py [--random N] [--seed SEED]
+#
+# Checks that ArpaLM reads ARPA models where the history of an N-gram is
+# missing from the lower order N-grams. Such models are generated randomly, and
+# read using read(), read_parallel(), and read_binary() after save_binary().
+# The probabilities given by prob(), batch_prob(), and score_word() are
+# compared to a dictionary-based backoff model, where a missing history has the
+# backoff weight 1. The histories that ArpaLM adds must not be visible through
+# ngram(), mgrams(), or save(). Prints the number of checked cases, and exits
+# with status 1 if any of them failed.
+
+import argparse
+import gzip
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import numpy
+from ArpaLM import ArpaLM
+
+# Generates a random model as a dictionary from word tuples to log10
+# probabilities and backoff weights. Some histories of the higher order N-grams
+# are removed, so that the model has missing histories of every order.
+def random_model(rng, order):
+	vocabulary = ['<s>', '</s>', '<unk>'] + ['w%d' % i for i in range(rng.randint(3, 8))]
+	model = {(w,): (rng.uniform(-3, -0.5), rng.uniform(-1, 0)) for w in vocabulary}
+	for n in range(2, order + 1):
+		histories = [ng for ng in model if len(ng) == n - 1]
+		for history in rng.sample(histories, min(len(histories), 15)):
+			for w in rng.sample(vocabulary, rng.randint(1, 4)):
+				model[history + (w,)] = (rng.uniform(-3, -0.5), rng.uniform(-1, 0))
+		for ng in rng.sample(histories, len(histories) // 4):
+			if len(ng) > 1:
+				del model[ng]
+	return model
+
+def write_arpa(model, order, fh):
+	fh.write("\\data\\\n")
+	for n in range(1, order + 1):
+		fh.write("ngram %d=%d\n" % (n, sum(1 for ng in model if len(ng) == n)))
+	for n in range(1, order + 1):
+		fh.write("\n\\%d-grams:\n" % n)
+		for ng, (prob, bowt) in model.items():
+			if len(ng) != n:
+				continue
+			if n == order:
+				fh.write("%.6f %s\n" % (prob, ' '.join(ng)))
+			else:
+				fh.write("%.6f %s %.6f\n" % (prob, ' '.join(ng), bowt))
+	fh.write("\n\\end\\\n")
+
+# Computes the log10 probability of ng[-1] after ng[:-1] from the dictionary.
+def expected_prob(model, ng):
+	if ng in model:
+		return model[ng][0]
+	bowt = model[ng[:-1]][1] if ng[:-1] in model else 0.0
+	return bowt + expected_prob(model, ng[1:])
+
+# Compares the probabilities given by lm to the dictionary, and checks that the
+# added histories are not visible. Returns the number of checked cases and the
+# number of failures.
+def check_lm(lm, model, order, name, rng):
+	vocabulary = sorted(ng[0] for ng in model if len(ng) == 1)
+	queries = [ng for ng in model]
+	# N-grams whose history was removed, and random word sequences.
+	queries += [ng[1:] for ng in model if len(ng) > 2]
+	queries += [tuple(rng.choice(vocabulary) for i in range(rng.randint(1, order)))
+	            for j in range(100)]
+	num_failures = 0
+
+	def fail(message):
+		nonlocal num_failures
+		num_failures += 1
+		sys.stderr.write("%s: %s\n" % (name, message))
+
+	for ng in queries:
+		expected = expected_prob(model, ng)
+		found = lm.prob(*reversed(ng)) / math.log(10)
+		if abs(found - expected) > 1e-4:
+			fail("prob%s: expected %.6f, found %.6f" % (ng, expected, found))
+		state = lm.initial_state(ng[:-1])
+		found = lm.score_word(state, ng[-1])[0] / math.log(10)
+		if abs(found - expected) > 1e-4:
+			fail("score_word%s: expected %.6f, found %.6f" % (ng, expected, found))
+	# batch_prob() doesn't score the first word of a sentence, so the
+	# last probability of each sentence is the one of the whole N-gram.
+	sentences = [ng for ng in queries if len(ng) > 1]
+	probs = lm.batch_prob([lm.word_ids(ng) for ng in sentences])
+	ends = numpy.cumsum([len(ng) - 1 for ng in sentences]) - 1
+	for ng, found in zip(sentences, probs[ends] / math.log(10)):
+		expected = expected_prob(model, ng)
+		if abs(found - expected) > 1e-4:
+			fail("batch_prob%s: expected %.6f, found %.6f" % (ng, expected, found))
+
+	found = set(ng.words for m in range(order) for ng in lm.mgrams(m))
+	if found != set(model):
+		fail("mgrams() returned %d N-grams, expected %d" % (len(found), len(model)))
+	for ng in set(queries) - set(model):
+		try:
+			lm.ngram(*reversed(ng))
+			fail("ngram%s found an N-gram that is not in the model" % (ng,))
+		except KeyError:
+			pass
+
+	return len(queries) * 2 + len(sentences) + 1, num_failures
+
+# Checks that save() writes the same N-grams that are in the dictionary.
+def check_saved(lm, model, path, name):
+	lm.save(path, threaded=False)
+	ngrams = set()
+	with gzip.open(path, 'rt') as fh:
+		n = 0
+		for line in fh:
+			if line.startswith('\\') and line.strip().endswith('-grams:'):
+				n = int(line.strip()[1:-7])
+				continue
+			fields = line.split()
+			if (n > 0) and (len(fields) > n):
+				ngrams.add(tuple(fields[1:n+1]))
+	expected = set(model)
+	if ngrams != expected:
+		sys.stderr.write("%s: save() wrote %d N-grams, expected %d\n" % \
+			(name, len(ngrams), len(expected)))
+		return 1, 1
+	return 1, 0
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--random', metavar='N', type=int, default=20,
+                   help='check N randomly generated models')
+parser.add_argument('--seed', type=int, default=1,
+                   help='random seed for generating the models')
+args = parser.parse_args()
+
+num_cases = 0
+num_failures = 0
+rng = random.Random(args.seed)
+temp_dir = tempfile.mkdtemp()
+try:
+	for index in range(args.random):
+		order = rng.randint(2, 4)
+		model = random_model(rng, order)
+		arpa_path = os.path.join(temp_dir, 'model.arpa')
+		binary_path = os.path.join(temp_dir, 'model.bin')
+		saved_path = os.path.join(temp_dir, 'saved.arpa.gz')
+		with open(arpa_path, 'w') as fh:
+			write_arpa(model, order, fh)
+
+		lms = []
+		lm = ArpaLM()
+		with open(arpa_path) as fh:
+			lm.read(fh)
+		lms.append(("read", lm))
+		lm = ArpaLM()
+		lm.read_parallel(arpa_path, 2)
+		lms.append(("read_parallel", lm))
+		lms[0][1].save_binary(binary_path)
+		lm = ArpaLM()
+		lm.read_binary(binary_path)
+		lms.append(("read_binary", lm))
+
+		for method, lm in lms:
+			name = "random model %d, %s" % (index, method)
+			cases, failures = check_lm(lm, model, order, name, rng)
+			num_cases += cases
+			num_failures += failures
+			cases, failures = check_saved(lm, model, saved_path, name)
+			num_cases += cases
+			num_failures += failures
+finally:
+	shutil.rmtree(temp_dir)
+
+sys.stdout.write("%d cases checked, %d failed.\n" % (num_cases, num_failures))
+if num_failures > 0:
+	sys.exit(1)
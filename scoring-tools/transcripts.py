@@ -21,6 +21,71 @@ def trn_alternation(alternation):
 		words.append(alternation)
 	return ' '.join(words)
 
+# Parses an utterance in trn format into a transcript: a list whose elements
+# are words or alternations. An alternation is a list of alternative word
+# sequences.
+def parse_utterance(utterance):
+	transcript = []
+	pos = 0
+	while pos < len(utterance):
+		alt_pos = utterance.find('{', pos)
+		if alt_pos == -1:
+			transcript.extend(utterance[pos:].split())
+			break
+		transcript.extend(utterance[pos:alt_pos].split())
+		alt_pos += 1
+		alt_end = utterance.find('}', alt_pos)
+		alternation = utterance[alt_pos:alt_end].split('/')
+		alternation = [x.split() for x in alternation]
+		transcript.append(alternation)
+		pos = alt_end + 1
+	return transcript
+
+# Reads a transcript file in trn format one line at a time. Yields the
+# utterance ID and the transcript of each line, in the order of the file, so
+# that the file does not have to fit in memory. Empty lines are skipped.
+def trn_utterances(input_file):
+	for line in input_file:
+		if not line.strip():
+			continue
+		utterance_end = line.index('(')
+		id_start = utterance_end + 1
+		id_end = line.index(')', id_start)
+		utterance = line[:utterance_end].strip()
+		utterance_id = line[id_start:id_end].strip()
+		yield utterance_id, parse_utterance(utterance)
+
+# Compiles a transcript into a word graph. The nodes are numbered in
+# topological order, node 0 being the start and the last node the end of the
+# transcript. Returns the number of nodes and a list of (start node, end node,
+# word) links, sorted by start node. The word is None in links that represent
+# the "@" (NULL) alternative.
+def transcript_graph(transcript):
+	links = []
+	node = 0
+	num_nodes = 1
+	for token in transcript:
+		if type(token) is list:
+			ends = []
+			for seq in token:
+				if (not seq) or (seq == ['@']):
+					ends.append((node, None))
+					continue
+				prev = node
+				for word in seq[:-1]:
+					links.append((prev, num_nodes, word))
+					prev = num_nodes
+					num_nodes += 1
+				ends.append((prev, seq[-1]))
+			for start, word in ends:
+				links.append((start, num_nodes, word))
+		else:
+			links.append((node, num_nodes, token))
+		node = num_nodes
+		num_nodes += 1
+	links.sort(key=lambda x: x[0])
+	return num_nodes, links
+
 class Transcripts:
 	'''
 	A transcript database.
@@ -34,13 +99,8 @@ class Transcripts:
 			yield utterance_id, transcript
 	
 	def read_trn(self, input_file):
-		for line in input_file:
-			utterance_end = line.index('(')
-			id_start = utterance_end + 1
-			id_end = line.index(')', id_start)
-			utterance = line[:utterance_end].strip()
-			utterance_id = line[id_start:id_end].strip()
-			self.set_utterance(utterance_id, utterance)
+		for utterance_id, transcript in trn_utterances(input_file):
+			self.set_transcript(utterance_id, transcript)
 	
 	def write_trn(self, output_file):
 		for utterance_id, transcript in self.__transcripts.items():
@@ -48,21 +108,7 @@ class Transcripts:
 			output_file.write(line.encode('utf-8') + '\n')
 	
 	def set_utterance(self, utterance_id, utterance):
-		transcript = []
-		pos = 0
-		while pos < len(utterance):
-			alt_pos = utterance.find('{', pos)
-			if alt_pos == -1:
-				transcript.extend(utterance[pos:].split())
-				break
-			transcript.extend(utterance[pos:alt_pos].split())
-			alt_pos += 1
-			alt_end = utterance.find('}', alt_pos)
-			alternation = utterance[alt_pos:alt_end].split('/')
-			alternation = [x.split() for x in alternation]
-			transcript.append(alternation)
-			pos = alt_end + 1
-		self.__transcripts[utterance_id] = transcript
+		self.__transcripts[utterance_id] = parse_utterance(utterance)
 	
 	def set_transcript(self, utterance_id, transcript):
 		self.__transcripts[utterance_id] = transcript